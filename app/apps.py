@@ -1,6 +1,28 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 
 
 class AppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'app'
+
+    def ready(self):
+        from .encryption import (
+            configure_compression, configure_key_cache, configure_lookup_key_cache,
+        )
+        from .metrics import configure_metrics
+        from .users import configure_user_cache  # also connects the cache's AppUser signals
+
+        if not settings.ENCRYPTION_LOOKUP_PEPPER:
+            raise ImproperlyConfigured('Set ENCRYPTION_LOOKUP_PEPPER - see encrypted_db/settings.py')
+        if key_cache := getattr(settings, 'ENCRYPTION_KEY_CACHE', None):
+            configure_key_cache(**key_cache)
+        if lookup_key_cache := getattr(settings, 'ENCRYPTION_LOOKUP_KEY_CACHE', None):
+            configure_lookup_key_cache(**lookup_key_cache)
+        if compression := getattr(settings, 'ENCRYPTION_COMPRESSION', None):
+            configure_compression(**compression)
+        if metrics := getattr(settings, 'ENCRYPTION_METRICS', None):
+            configure_metrics(**metrics)
+        if user_cache := getattr(settings, 'APP_USER_CACHE', None):
+            configure_user_cache(**user_cache)
@@ -0,0 +1,332 @@
+'''The message store as a file, for backups and moving between environments
+
+Rows are written exactly as stored - still encrypted, never decrypted - so no passphrase is needed
+to export or import. The file is gzipped NDJSON:
+
+    {"format": "encrypted-db-export", "version": 1, "tables": {"app.appuser": ["id", ...], ...}}
+    ["6f1c...", "Alfie", "2025-01-26T10:13:11.098331Z"]      <- one JSON array per row
+    ...
+    {"table": "app.appuser", "rows": 1000, "sha256": "..."}  <- closes each chunk of rows
+    ...
+    {"end": true, "rows": {"app.appuser": 2, ...}}
+
+Each chunk's checksum covers its row lines, so corruption is caught before the chunk is imported,
+and the closing line catches a truncated file. Tables come in dependency order, and rows are
+streamed both ways a chunk at a time, so memory does not grow with the table. The export is read
+from one snapshot, so it is consistent even while messages are being sent.
+'''
+import base64
+import gzip
+import hashlib
+import json
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+from typing import BinaryIO, Iterator
+from uuid import UUID
+
+from django.db import IntegrityError, connection, models, transaction
+
+from .models import (
+    AppUser, Conversation, EncryptedChunk, KeyEnvelope, Message, MessageEncrypted, Sequence,
+)
+
+EXPORT_FORMAT = 'encrypted-db-export'
+EXPORT_VERSION = 1
+
+
+def export_models() -> list[type[models.Model]]:
+    '''Everything a message needs, in the order it has to be inserted'''
+    return [
+        AppUser, KeyEnvelope, Conversation, Conversation.participants.through,
+        MessageEncrypted, Message, EncryptedChunk,
+    ]
+
+
+def _columns(model) -> list[str]:
+    return [field.attname for field in model._meta.concrete_fields]
+
+
+def _key_columns(model) -> list[str]:
+    '''The columns that identify a row in any database - an auto-increment id does not'''
+    if not isinstance(model._meta.pk, models.AutoField):
+        return [model._meta.pk.attname]
+    unique = [
+        *model._meta.unique_together,
+        *(constraint.fields for constraint in model._meta.constraints
+          if isinstance(constraint, models.UniqueConstraint)),
+    ]
+    return [model._meta.get_field(name).attname for name in unique[0]]
+
+
+def _binary_positions(model, columns: list[str]) -> set[int]:
+    # bytes are not JSON - they are written as base64
+    binary = {
+        field.attname for field in model._meta.concrete_fields
+        if isinstance(field, models.BinaryField)
+    }
+    return {position for position, column in enumerate(columns) if column in binary}
+
+
+def _json_default(value):
+    # not DjangoJSONEncoder - it rounds datetimes to milliseconds
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, UUID):
+        return str(value)
+    raise TypeError(f'Cannot export {type(value).__name__}')
+
+
+def _dumps(value) -> bytes:
+    return json.dumps(value, default=_json_default, separators=(',', ':')).encode() + b'\n'
+
+
+def _chunk_end(label: str, count: int, checksum) -> bytes:
+    return _dumps({'table': label, 'rows': count, 'sha256': checksum.hexdigest()})
+
+
+@contextmanager
+def _snapshot():
+    '''One transaction that sees the database as it was when it started, for the whole export'''
+    if connection.in_atomic_block:  # the caller's transaction decides what is seen
+        yield
+    elif connection.vendor == 'postgresql':
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY')
+            yield
+    elif connection.vendor == 'sqlite':
+        # A read transaction under WAL already sees one snapshot - but BEGIN IMMEDIATE (see
+        # encrypted_db/database.py) would also lock every writer out until the export finished
+        connection.ensure_connection()
+        mode, connection.transaction_mode = connection.transaction_mode, 'DEFERRED'
+        try:
+            with transaction.atomic():
+                connection.transaction_mode = mode
+                yield
+        finally:
+            connection.transaction_mode = mode
+    else:
+        with transaction.atomic():
+            yield
+
+
+def write_export(fileobj: BinaryIO, batch_size: int = 1000) -> dict[str, int]:
+    '''Write every exported table to `fileobj` (binary, uncompressed - see export_to_file)'''
+    with _snapshot():
+        return _write_tables(fileobj, batch_size)
+
+
+def _write_tables(fileobj: BinaryIO, batch_size: int) -> dict[str, int]:
+    tables = {model._meta.label_lower: _columns(model) for model in export_models()}
+    fileobj.write(_dumps({'format': EXPORT_FORMAT, 'version': EXPORT_VERSION, 'tables': tables}))
+
+    totals = {}
+    for model in export_models():
+        label, columns = model._meta.label_lower, tables[model._meta.label_lower]
+        binary = _binary_positions(model, columns)
+        # messages in the order they were sent, which the import numbers them in
+        order = 'sequence' if model is Message else 'pk'
+        rows = model.objects.order_by(order).values_list(*columns).iterator(chunk_size=batch_size)
+
+        count, checksum = 0, hashlib.sha256()
+        for row in rows:
+            if binary:
+                row = [
+                    base64.b64encode(value).decode() if i in binary and value is not None else value
+                    for i, value in enumerate(row)
+                ]
+            line = _dumps(row)
+            checksum.update(line)
+            fileobj.write(line)
+            count += 1
+            if count == batch_size:
+                fileobj.write(_chunk_end(label, count, checksum))
+                totals[label] = totals.get(label, 0) + count
+                count, checksum = 0, hashlib.sha256()
+        if count:
+            fileobj.write(_chunk_end(label, count, checksum))
+            totals[label] = totals.get(label, 0) + count
+
+    fileobj.write(_dumps({'end': True, 'rows': totals}))
+    return totals
+
+
+def _lines(fileobj: BinaryIO) -> Iterator[bytes]:
+    try:
+        yield from fileobj
+    except (EOFError, zlib.error) as error:  # the gzip stream itself is cut short or damaged
+        raise ValueError(f'Export is truncated or corrupt: {error}') from error
+
+
+def read_export(fileobj: BinaryIO) -> Iterator[tuple[type[models.Model], list[str], list[list]]]:
+    '''(model, columns, rows) for each chunk of `fileobj`, only once its checksum has been verified
+
+    Raises ValueError for anything that is not a complete, intact export.
+    '''
+    lines = _lines(fileobj)
+    header = json.loads(next(lines, b'null'))
+    if not isinstance(header, dict) or header.get('format') != EXPORT_FORMAT:
+        raise ValueError('Not a message export')
+    if header.get('version') != EXPORT_VERSION:
+        raise ValueError(f'Unsupported export version {header.get("version")}')
+
+    by_label = {model._meta.label_lower: model for model in export_models()}
+    for label, columns in header['tables'].items():
+        if label not in by_label or not set(columns) <= set(_columns(by_label[label])):
+            raise ValueError(f'{label} in the export does not match this database')
+
+    rows, checksum, totals = [], hashlib.sha256(), {}
+    for number, line in enumerate(lines, start=1):
+        if line.startswith(b'['):
+            checksum.update(line)
+            rows.append(json.loads(line))
+            continue
+
+        marker = json.loads(line)
+        if marker.get('end'):
+            if marker['rows'] != totals or rows:
+                raise ValueError('Export is missing rows')
+            return
+        label = marker['table']
+        if marker['rows'] != len(rows) or marker['sha256'] != checksum.hexdigest():
+            raise ValueError(f'Checksum mismatch in the {label} chunk ending on line {number + 1}')
+        totals[label] = totals.get(label, 0) + len(rows)
+        yield by_label[label], header['tables'][label], rows
+        rows, checksum = [], hashlib.sha256()
+
+    raise ValueError('Export is truncated')
+
+
+def _decode(model, columns: list[str], rows: list[list]) -> list[dict]:
+    binary = _binary_positions(model, columns)
+    values = [
+        dict(zip(columns, [
+            base64.b64decode(value) if i in binary and value is not None else value
+            for i, value in enumerate(row)
+        ]))
+        for row in rows
+    ]
+    if isinstance(model._meta.pk, models.AutoField):
+        for row in values:  # ids from another database - this one numbers its own rows
+            row.pop(model._meta.pk.attname, None)
+    return values
+
+
+def _merge_conversations(rows: list[dict], merged: dict[str, str]) -> list[dict]:
+    '''Drop the conversations this database already has under the same pair key, noting in
+    `merged` which of its conversations their messages now belong to'''
+    existing = dict(Conversation.objects.filter(
+        pair_key__in=[row['pair_key'] for row in rows]
+    ).values_list('pair_key', 'id'))
+    new_rows = []
+    for row in rows:
+        existing_id = existing.get(row['pair_key'])
+        if existing_id is None or str(existing_id) == row['id']:
+            new_rows.append(row)  # one already imported is a conflict, like any other row
+        else:
+            merged[row['id']] = str(existing_id)
+    return new_rows
+
+
+def _new_rows(model, rows: list[dict], ignore_conflicts: bool) -> list[dict]:
+    '''The rows not already in the database
+
+    Raises ValueError for a row that is, unless `ignore_conflicts`. Rows without an id of their own
+    (a conversation's participants, a body's chunks) are always skipped: they carry nothing beyond
+    their parent, which has been checked already.
+    '''
+    columns = _key_columns(model)
+    lookup = {f'{columns[0]}__in': {row[columns[0]] for row in rows}}
+    existing = {
+        tuple(str(value) for value in key)
+        for key in model.objects.filter(**lookup).values_list(*columns).iterator()
+    }
+    new_rows = []
+    for row in rows:
+        key = tuple(str(row[column]) for column in columns)
+        if key not in existing:
+            new_rows.append(row)
+        elif not (ignore_conflicts or isinstance(model._meta.pk, models.AutoField)):
+            raise ValueError(
+                f'{model._meta.label_lower} {", ".join(key)} already exists - '
+                'pass --ignore-conflicts to skip the rows already imported'
+            )
+    return new_rows
+
+
+def _renumber(messages: list[dict]):
+    '''Fresh sequence numbers after any already given out, keeping the exported order'''
+    first = Sequence.allocate('message', len(messages))
+    conversations = {}
+    for offset, message in enumerate(sorted(messages, key=lambda message: message['sequence'])):
+        message['sequence'] = first + offset
+        if message['conversation_id'] is not None:
+            conversations.setdefault(message['conversation_id'], []).append(message)
+    for conversation_id, in_conversation in conversations.items():
+        in_conversation.sort(key=lambda message: message['conversation_sequence'])
+        name = Conversation(id=conversation_id).sequence_name
+        first = Sequence.allocate(name, len(in_conversation))
+        for offset, message in enumerate(in_conversation):
+            message['conversation_sequence'] = first + offset
+
+
+def import_rows(fileobj: BinaryIO, ignore_conflicts: bool = False) -> dict[str, int]:
+    '''Insert every chunk of an export, one transaction each, returning the rows inserted per table
+
+    The database does not need to be empty. Imported conversations are merged into any with the
+    same pair key, and messages are numbered after the ones already there. A row that was imported
+    before raises ValueError - or, with `ignore_conflicts`, is skipped, e.g. to finish off an
+    import that was interrupted.
+    '''
+    totals, merged = {}, {}
+    for model, columns, rows in read_export(fileobj):
+        label = model._meta.label_lower
+        rows = _decode(model, columns, rows)
+        if model is Conversation:
+            rows = _merge_conversations(rows, merged)
+        if 'conversation_id' in columns:
+            for row in rows:
+                row['conversation_id'] = merged.get(row['conversation_id'], row['conversation_id'])
+        rows = _new_rows(model, rows, ignore_conflicts)
+
+        # bulk_create stamps auto_now(_add) fields with the current time - put the originals back
+        stamped = [
+            field.attname for field in model._meta.concrete_fields if field.attname in columns
+            and (getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False))
+        ]
+        try:
+            with transaction.atomic():
+                if model is Message and rows:
+                    _renumber(rows)
+                instances = [model(**row) for row in rows]
+                model.objects.bulk_create(instances)
+                if stamped and instances:
+                    for instance, row in zip(instances, rows):
+                        for name in stamped:
+                            setattr(instance, name, row[name])
+                    model.objects.bulk_update(instances, stamped)
+        except IntegrityError as error:
+            raise ValueError(f'Could not import a {label} chunk: {error}') from error
+        totals[label] = totals.get(label, 0) + len(rows)
+    return totals
+
+
+def export_to_file(path: str, batch_size: int = 1000) -> dict[str, int]:
+    with gzip.open(path, 'wb', compresslevel=6) as fileobj:  # 9 is much slower, barely smaller
+        return write_export(fileobj, batch_size)
+
+
+def import_from_file(path: str, ignore_conflicts: bool = False) -> dict[str, int]:
+    with gzip.open(path, 'rb') as fileobj:
+        return import_rows(fileobj, ignore_conflicts)
+
+
+def check_file(path: str) -> dict[str, int]:
+    '''Verify an export without importing it'''
+    totals = {}
+    with gzip.open(path, 'rb') as fileobj:
+        for model, _, rows in read_export(fileobj):
+            label = model._meta.label_lower
+            totals[label] = totals.get(label, 0) + len(rows)
+    return totals
@@ -1,11 +1,122 @@
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.backends import default_backend
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, InvalidToken
+from collections import OrderedDict
+from typing import Iterable, Iterator, NamedTuple
 import base64
+import hashlib
+import hmac
+import os
+import struct
+import threading
+import time
+import zlib
 
+from .metrics import timed
 
-def _derive_key(key: str, salt: int) -> bytes:
+
+class DerivedKeyCache:
+    '''Bounded LRU cache of derived keys, with expiry
+
+    Entries are looked up by an HMAC of (passphrase, salt) under a random per-process secret, so
+    neither the passphrase nor anything that can be brute-forced offline ends up as a dict key.
+    Derived keys are held in bytearrays so they can be overwritten on eviction and purge.
+    '''
+    def __init__(self, max_size: int = 128, ttl: float = 300.0):
+        if max_size < 1:
+            raise ValueError('max_size must be at least 1')
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._secret = os.urandom(32)
+        self._entries: OrderedDict[bytes, tuple[float, bytearray]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _lookup_key(self, key: str, salt: int, context: str) -> bytes:
+        # context never contains NUL and salt is fixed-width, so the message is unambiguous
+        message = context.encode() + b'\x00' + salt.to_bytes(16, byteorder='big') + key.encode()
+        return hmac.new(self._secret, message, hashlib.sha256).digest()
+
+    @staticmethod
+    def _wipe(value: bytearray):
+        value[:] = bytes(len(value))
+
+    def get_or_derive(self, key: str, salt: int, derive, context: str = '') -> bytes:
+        '''`context` tells apart derivations of the same (key, salt), e.g. the KDF used'''
+        lookup_key = self._lookup_key(key, salt, context)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(lookup_key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._entries.move_to_end(lookup_key)
+                    self.hits += 1
+                    return bytes(value)
+                del self._entries[lookup_key]
+                self._wipe(value)
+            self.misses += 1
+
+        # derive outside the lock - it is slow and must not serialise unrelated requests
+        derived = derive(key, salt)
+
+        with self._lock:
+            if lookup_key in self._entries:
+                self._wipe(self._entries.pop(lookup_key)[1])
+            self._entries[lookup_key] = (now + self.ttl, bytearray(derived))
+            while len(self._entries) > self.max_size:
+                self._wipe(self._entries.popitem(last=False)[1][1])
+
+        return derived
+
+    def purge(self):
+        with self._lock:
+            for _, value in self._entries.values():
+                self._wipe(value)
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self), 'max_size': self.max_size}
+
+
+# Disabled unless configured (see ENCRYPTION_KEY_CACHE in settings)
+_key_cache: DerivedKeyCache | None = None
+
+
+def configure_key_cache(max_size: int = 128, ttl: float = 300.0) -> DerivedKeyCache:
+    global _key_cache
+    disable_key_cache()
+    _key_cache = DerivedKeyCache(max_size=max_size, ttl=ttl)
+    return _key_cache
+
+
+def disable_key_cache():
+    global _key_cache
+    if _key_cache is not None:
+        _key_cache.purge()
+    _key_cache = None
+
+
+def get_key_cache() -> DerivedKeyCache | None:
+    return _key_cache
+
+
+def purge_key_cache():
+    if _key_cache is not None:
+        _key_cache.purge()
+
+
+def _pbkdf2(key: str, salt: int) -> bytes:
     kdf = PBKDF2HMAC(
         algorithm=hashes.SHA256(),
         length=32,
@@ -16,16 +127,434 @@ def _derive_key(key: str, salt: int) -> bytes:
     return base64.urlsafe_b64encode(kdf.derive(key.encode()))
 
 
-def encrypt_data(key: str, salt: int, data: str) -> str:
-    fernet_key = _derive_key(key, salt)
-    fernet = Fernet(fernet_key)
-    encrypted_data = fernet.encrypt(data.encode())
-    encrypted_base64 = base64.b64encode(encrypted_data).decode('utf-8')
-    return encrypted_base64
+# Key derivation functions. All return 32 bytes of key material, urlsafe-base64 encoded as Fernet
+# expects - the AEAD ciphers decode it again.
+class Pbkdf2Kdf:
+    name = 'pbkdf2-sha256-100k'
+
+    def derive(self, key: str, salt: int) -> bytes:
+        return _pbkdf2(key, salt)
+
+
+class ScryptKdf:
+    name = 'scrypt-n16384-r8-p1'
+
+    def derive(self, key: str, salt: int) -> bytes:
+        kdf = Scrypt(salt=salt.to_bytes(16, byteorder='big'), length=32, n=2**14, r=8, p=1)
+        return base64.urlsafe_b64encode(kdf.derive(key.encode()))
+
+
+class HkdfKdf:
+    '''No stretching at all - only for keys that are already strong, e.g. random API keys'''
+    name = 'hkdf-sha256'
+
+    def derive(self, key: str, salt: int) -> bytes:
+        kdf = HKDF(
+            algorithm=hashes.SHA256(), length=32,
+            salt=salt.to_bytes(16, byteorder='big'), info=b'encrypted_db',
+        )
+        return base64.urlsafe_b64encode(kdf.derive(key.encode()))
+
+
+KDFS = {kdf.name: kdf for kdf in (Pbkdf2Kdf(), ScryptKdf(), HkdfKdf())}
+
+
+# Ciphers. Each takes the key material above, and turns bytes into a str token and back.
+class FernetCipher:
+    '''AES-128-CBC + HMAC-SHA256. Tokens are bare Fernet tokens, starting with its version byte'''
+    name = 'fernet'
+
+    def __init__(self, key_material: bytes):
+        self._fernet = Fernet(key_material)
+
+    def encrypt(self, plaintext: bytes) -> str:
+        return self._fernet.encrypt(plaintext).decode('utf-8')
+
+    def decrypt(self, token: str) -> bytes:
+        if is_legacy_token(token):
+            token = from_legacy_token(token)
+        return self._fernet.decrypt(token.encode('utf-8'))
+
+
+class _AeadCipher:
+    '''Tokens are urlsafe-base64 of header byte + 12-byte random nonce + ciphertext and tag
+
+    The header identifies the cipher, and is authenticated as associated data.
+    '''
+    name: str
+    header: bytes
+    aead_class = None
+
+    def __init__(self, key_material: bytes):
+        self._aead = self.aead_class(base64.urlsafe_b64decode(key_material))
+
+    def encrypt(self, plaintext: bytes) -> str:
+        nonce = os.urandom(12)
+        ciphertext = self._aead.encrypt(nonce, plaintext, self.header)
+        return base64.urlsafe_b64encode(self.header + nonce + ciphertext).decode('utf-8')
+
+    def decrypt(self, token: str) -> bytes:
+        raw = base64.urlsafe_b64decode(token.encode('utf-8'))
+        if raw[:1] != self.header:
+            raise InvalidToken
+        try:
+            return self._aead.decrypt(raw[1:13], raw[13:], self.header)
+        except InvalidTag:
+            raise InvalidToken
+
+
+class AesGcmCipher(_AeadCipher):
+    name = 'aes256gcm'
+    header = b'\x01'
+    aead_class = AESGCM
+
+
+class ChaCha20Poly1305Cipher(_AeadCipher):
+    name = 'chacha20poly1305'
+    header = b'\x02'
+    aead_class = ChaCha20Poly1305
+
+
+CIPHERS = {cipher.name: cipher for cipher in (FernetCipher, AesGcmCipher, ChaCha20Poly1305Cipher)}
+_CIPHERS_BY_HEADER = {AesGcmCipher.header: AesGcmCipher, ChaCha20Poly1305Cipher.header: ChaCha20Poly1305Cipher}
+
+
+def _token_cipher(token: str):
+    '''The cipher a stored token was written with'''
+    if token.startswith(TOKEN_PREFIX) or is_legacy_token(token):
+        return FernetCipher
+    header = base64.urlsafe_b64decode(token[:4].encode('utf-8'))[:1]
+    if header not in _CIPHERS_BY_HEADER:
+        raise InvalidToken
+    return _CIPHERS_BY_HEADER[header]
+
+
+class Scheme(NamedTuple):
+    kdf: str
+    cipher: str
+
+
+# Stored on every encrypted row, so old rows keep decrypting as new writes move to other schemes.
+# Never change or reuse a version - add a new one.
+SCHEMES = {
+    1: Scheme(Pbkdf2Kdf.name, FernetCipher.name),
+    2: Scheme(Pbkdf2Kdf.name, AesGcmCipher.name),
+    3: Scheme(Pbkdf2Kdf.name, ChaCha20Poly1305Cipher.name),
+    4: Scheme(ScryptKdf.name, AesGcmCipher.name),
+    5: Scheme(ScryptKdf.name, ChaCha20Poly1305Cipher.name),
+    6: Scheme(HkdfKdf.name, AesGcmCipher.name),
+    7: Scheme(HkdfKdf.name, ChaCha20Poly1305Cipher.name),
+}
+DEFAULT_SCHEME = 1
+
+
+@timed('crypto.kdf')
+def _derive_key(key: str, salt: int, kdf: str = Pbkdf2Kdf.name) -> bytes:
+    derive = KDFS[kdf].derive
+    if _key_cache is not None:
+        return _key_cache.get_or_derive(key, salt, derive, context=kdf)
+    return derive(key, salt)
+
+
+# Optional compression of large values before they are encrypted. Compressed plaintexts start with
+# a 0xFF byte - which never starts UTF-8 text, so values written without compression stay
+# unambiguous - then a byte naming the algorithm. Both are inside the ciphertext, so authenticated.
+_COMPRESSED = b'\xff'
+_ZLIB = b'\x01'
+
+# Disabled unless configured (see ENCRYPTION_COMPRESSION in settings)
+_compression: dict | None = None
+
+
+def configure_compression(threshold: int = 1024, level: int = 6):
+    '''Compress values of at least `threshold` bytes, when that makes them smaller'''
+    global _compression
+    _compression = {'threshold': threshold, 'level': level}
+
+
+def disable_compression():
+    global _compression
+    _compression = None
+
+
+def _pack(data: str) -> bytes:
+    plaintext = data.encode()
+    if _compression is not None and len(plaintext) >= _compression['threshold']:
+        compressed = zlib.compress(plaintext, _compression['level'])
+        if len(compressed) + 2 < len(plaintext):
+            return _COMPRESSED + _ZLIB + compressed
+    return plaintext
+
+
+def _unpack(plaintext: bytes) -> str:
+    if plaintext[:1] == _COMPRESSED:
+        if plaintext[1:2] != _ZLIB:
+            raise InvalidToken
+        plaintext = zlib.decompress(plaintext[2:])
+    return plaintext.decode()
+
+
+class _Ciphers:
+    '''One key's cipher objects, built as tokens of each kind are met'''
+    def __init__(self, key_material: bytes):
+        self.key_material = key_material
+        self._ciphers = {}
+
+    def get(self, cipher_class):
+        if cipher_class not in self._ciphers:
+            self._ciphers[cipher_class] = cipher_class(self.key_material)
+        return self._ciphers[cipher_class]
+
+    @timed('crypto.cipher_encrypt')
+    def encrypt(self, scheme: int, data: str) -> str:
+        return self.get(CIPHERS[SCHEMES[scheme].cipher]).encrypt(_pack(data))
+
+    @timed('crypto.cipher_decrypt')
+    def decrypt(self, token: str) -> str:
+        # the cipher comes from the token itself; the scheme only matters for picking the KDF
+        return _unpack(self.get(_token_cipher(token)).decrypt(token))
+
+
+def record_key(key: str, salt: int, scheme: int = DEFAULT_SCHEME) -> bytes:
+    '''The key material a record with its own salt is encrypted under'''
+    return _derive_key(key, salt, SCHEMES[scheme].kdf)
+
+
+def _ciphers(key: str, salt: int, scheme: int) -> _Ciphers:
+    return _Ciphers(record_key(key, salt, scheme))
+
+
+# Fernet tokens are already urlsafe base64 text, starting with the version byte and the high bytes
+# of the timestamp. Values used to be stored base64-encoded a second time - those still decrypt.
+TOKEN_PREFIX = 'gAAAAA'
+LEGACY_TOKEN_PREFIX = 'Z0FBQUFB'  # base64 of TOKEN_PREFIX
+
+
+def is_legacy_token(encrypted_data: str) -> bool:
+    return encrypted_data.startswith(LEGACY_TOKEN_PREFIX)
+
+
+def from_legacy_token(encrypted_data: str) -> str:
+    return base64.b64decode(encrypted_data.encode('utf-8')).decode('utf-8')
+
+
+@timed('crypto.encrypt_data')
+def encrypt_data(key: str, salt: int, data: str, scheme: int = DEFAULT_SCHEME) -> str:
+    return _ciphers(key, salt, scheme).encrypt(scheme, data)
+
+
+@timed('crypto.decrypt_data')
+def decrypt_data(key: str, salt: int, encrypted_data: str, scheme: int = DEFAULT_SCHEME) -> str:
+    return _ciphers(key, salt, scheme).decrypt(encrypted_data)
+
+
+# The KDF is by far the most expensive step, and every field of a record shares the same key and
+# salt, so the record-level functions derive the key once and reuse it for every value.
+def encrypt_record(
+    key: str, salt: int, data: dict[str, str], scheme: int = DEFAULT_SCHEME
+) -> dict[str, str]:
+    ciphers = _ciphers(key, salt, scheme)
+    return {name: ciphers.encrypt(scheme, value) for name, value in data.items()}
+
+
+def decrypt_record(
+    key: str, salt: int, encrypted_data: dict[str, str], scheme: int = DEFAULT_SCHEME
+) -> dict[str, str]:
+    ciphers = _ciphers(key, salt, scheme)
+    return {name: ciphers.decrypt(value) for name, value in encrypted_data.items()}
+
+
+def encrypt_records(
+    key: str, salt: int, records: list[dict[str, str]], scheme: int = DEFAULT_SCHEME
+) -> list[dict[str, str]]:
+    '''Encrypt many records sharing a salt - one derivation for the batch, a fresh IV per value'''
+    ciphers = _ciphers(key, salt, scheme)
+    return [{name: ciphers.encrypt(scheme, value) for name, value in data.items()} for data in records]
+
+
+# Single-value decryptors, for callers that reuse one key across many values (or records)
+def record_decryptor(key: str, salt: int, scheme: int = DEFAULT_SCHEME):
+    return _ciphers(key, salt, scheme).decrypt
+
+
+def data_key_decryptor(data_key: bytes):
+    return _Ciphers(data_key).decrypt
+
+
+# Envelope encryption: a random data key encrypts the records and is itself stored wrapped by the
+# key stretched from the passphrase, so reading any number of records costs a single derivation.
+def generate_data_key() -> bytes:
+    return Fernet.generate_key()  # 32 random bytes, in the same form as derived keys
+
+
+def wrap_data_key(key: str, salt: int, data_key: bytes, scheme: int = DEFAULT_SCHEME) -> str:
+    return encrypt_data(key, salt, data_key.decode(), scheme)
+
+
+def unwrap_data_key(key: str, salt: int, wrapped_key: str, scheme: int = DEFAULT_SCHEME) -> bytes:
+    return decrypt_data(key, salt, wrapped_key, scheme).encode()
+
+
+def wrap_key(key_material: bytes, data_key: bytes, scheme: int = DEFAULT_SCHEME) -> str:
+    '''Wrap a key under key material that is already derived (a record key, or another data key)'''
+    return _Ciphers(key_material).encrypt(scheme, data_key.decode())
+
+
+def unwrap_key(key_material: bytes, wrapped_key: str) -> bytes:
+    return _Ciphers(key_material).decrypt(wrapped_key).encode()
+
+
+def encrypt_record_with_data_key(
+    data_key: bytes, data: dict[str, str], scheme: int = DEFAULT_SCHEME
+) -> dict[str, str]:
+    ciphers = _Ciphers(data_key)  # a fresh IV/nonce is generated for every value
+    return {name: ciphers.encrypt(scheme, value) for name, value in data.items()}
+
+
+def decrypt_record_with_data_key(data_key: bytes, encrypted_data: dict[str, str]) -> dict[str, str]:
+    ciphers = _Ciphers(data_key)
+    return {name: ciphers.decrypt(value) for name, value in encrypted_data.items()}
+
+
+# Blind indexes: deterministic, keyed digests of plaintext values that can be matched in SQL. The
+# lookup key is stretched from the passphrase like any other key, but with a fixed salt (derived
+# from a server-side pepper), so the same passphrase always gives the same digests.
+#
+# Every write under a passphrase needs its lookup key, so they are cached apart from other derived
+# keys (see ENCRYPTION_LOOKUP_KEY_CACHE in settings) - otherwise each send pays for a second
+# derivation. A lookup key only computes digests, it cannot decrypt anything.
+_lookup_key_cache: DerivedKeyCache | None = None
+
+
+def configure_lookup_key_cache(max_size: int = 64, ttl: float = 300.0) -> DerivedKeyCache:
+    global _lookup_key_cache
+    disable_lookup_key_cache()
+    _lookup_key_cache = DerivedKeyCache(max_size=max_size, ttl=ttl)
+    return _lookup_key_cache
+
+
+def disable_lookup_key_cache():
+    global _lookup_key_cache
+    if _lookup_key_cache is not None:
+        _lookup_key_cache.purge()
+    _lookup_key_cache = None
+
+
+def get_lookup_key_cache() -> DerivedKeyCache | None:
+    return _lookup_key_cache
+
+
+def purge_lookup_key_cache():
+    if _lookup_key_cache is not None:
+        _lookup_key_cache.purge()
+
+
+def derive_lookup_key(key: str, pepper: str) -> bytes:
+    salt = int.from_bytes(hashlib.sha256(f'lookup:{pepper}'.encode()).digest()[:16], byteorder='big')
+    if _lookup_key_cache is not None:
+        return base64.urlsafe_b64decode(
+            _lookup_key_cache.get_or_derive(key, salt, _derive_key, context='lookup')
+        )
+    return base64.urlsafe_b64decode(_derive_key(key, salt))
+
+
+def blind_index(lookup_key: bytes, field: str, value: str) -> str:
+    message = f'{field}:{value}'.encode()
+    return hmac.new(lookup_key, message, hashlib.sha256).hexdigest()[:32]
+
+
+def key_check_tag(lookup_key: bytes) -> str:
+    '''Short tag identifying the passphrase records were written with, without revealing it
+
+    Only 64 bits, so different passphrases can (rarely) share a tag - a match means "worth trying".
+    '''
+    return hmac.new(lookup_key, b'key-check', hashlib.sha256).hexdigest()[:16]
+
+
+# Streamed encryption, for bodies too large to hold in memory as one str. The stream is a header -
+# version byte, random 16-byte salt and the chunk size - followed by the plaintext in chunk-sized
+# pieces, each sealed with AES-256-GCM under a key derived (HKDF) from the record's key material and
+# the stream's salt. Each chunk's nonce is its index plus a flag marking the final chunk, and the
+# header is authenticated with every chunk, so chunks cannot be reordered, dropped or truncated.
+STREAM_VERSION = b'\x01'
+STREAM_CHUNK_SIZE = 64 * 1024
+_STREAM_HEADER = struct.Struct('>c16sI')
+_STREAM_TAG_SIZE = 16
+
+
+def _stream_aead(key_material: bytes, salt: bytes) -> AESGCM:
+    kdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=b'encrypted_db stream')
+    return AESGCM(kdf.derive(base64.urlsafe_b64decode(key_material)))
+
+
+def _stream_nonce(index: int, last: bool) -> bytes:
+    return index.to_bytes(11, byteorder='big') + (b'\x01' if last else b'\x00')
+
+
+def _rechunk(pieces: Iterable[bytes], size: int) -> Iterator[tuple[bytes, bool]]:
+    '''Regroup `pieces` into blocks of exactly `size` bytes (the last may be shorter, or empty), each
+    with whether it is the last'''
+    buffer = bytearray()
+    pending = None
+    for piece in pieces:
+        buffer += piece
+        while len(buffer) >= size:
+            if pending is not None:
+                yield pending, False
+            pending = bytes(buffer[:size])
+            del buffer[:size]
+    if pending is not None:
+        if not buffer:
+            yield pending, True
+            return
+        yield pending, False
+    yield bytes(buffer), True
+
+
+def encrypt_stream(
+    key_material: bytes, pieces: Iterable[bytes], chunk_size: int = STREAM_CHUNK_SIZE
+) -> Iterator[bytes]:
+    '''Encrypt bytes from any iterable (see iter_file), yielding the header then one frame per chunk
+
+    Only about one chunk is held in memory at a time.
+    '''
+    salt = os.urandom(16)
+    header = _STREAM_HEADER.pack(STREAM_VERSION, salt, chunk_size)
+    aead = _stream_aead(key_material, salt)
+    yield header
+    for index, (chunk, last) in enumerate(_rechunk(pieces, chunk_size)):
+        yield aead.encrypt(_stream_nonce(index, last), chunk, header)
+
+
+def decrypt_stream(key_material: bytes, frames: Iterable[bytes]) -> Iterator[bytes]:
+    '''Decrypt what encrypt_stream produced, however it has been split up since
+
+    Raises InvalidToken for a wrong key or a tampered or truncated stream - possibly after some
+    chunks have been yielded, as each is only checked when reached.
+    '''
+    frames = iter(frames)
+    buffer = bytearray()
+    for frame in frames:
+        buffer += frame
+        if len(buffer) >= _STREAM_HEADER.size:
+            break
+    if len(buffer) < _STREAM_HEADER.size:
+        raise InvalidToken
+    header = bytes(buffer[:_STREAM_HEADER.size])
+    version, salt, chunk_size = _STREAM_HEADER.unpack(header)
+    if version != STREAM_VERSION:
+        raise InvalidToken
+
+    aead = _stream_aead(key_material, salt)
+    rest = [bytes(buffer[_STREAM_HEADER.size:])]
+    chained = (piece for pieces in (rest, frames) for piece in pieces)
+    for index, (chunk, last) in enumerate(_rechunk(chained, chunk_size + _STREAM_TAG_SIZE)):
+        try:
+            yield aead.decrypt(_stream_nonce(index, last), chunk, header)
+        except InvalidTag:
+            raise InvalidToken
 
 
-def decrypt_data(key: str, salt: int, encrypted_data: str) -> str:
-    fernet_key = _derive_key(key, salt)
-    fernet = Fernet(fernet_key)
-    content = base64.b64decode(encrypted_data.encode('utf-8'))
-    return fernet.decrypt(content).decode()
+def iter_file(fileobj, size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+    '''Read a binary file-like object in `size` pieces, for encrypt_stream/decrypt_stream'''
+    return iter(lambda: fileobj.read(size), b'')
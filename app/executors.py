@@ -0,0 +1,197 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
+
+from .encryption import data_key_decryptor, record_decryptor, unwrap_data_key
+
+
+def _decrypt_jobs(jobs: list, skip_failures: bool = False) -> list[dict[str, str] | None]:
+    '''Decrypt a list of (key, salt, scheme, data key, values) jobs
+
+    Module-level and plain tuples in/out, so it can be pickled to worker processes. Rows written in
+    bulk share a salt, so each (salt, scheme) key is derived once per list, as in _rekey_job.
+    With `skip_failures`, rows that do not decrypt (or are None, because their envelope could not
+    be unwrapped) come back as None; otherwise the first failure raises.
+    '''
+    decryptors = {}
+    results = []
+    for job in jobs:
+        if job is None:
+            results.append(None)
+            continue
+        key, salt, scheme, data_key, values = job
+        try:
+            cache_key = data_key if data_key is not None else (salt, scheme)
+            if cache_key not in decryptors:
+                decryptors[cache_key] = (
+                    data_key_decryptor(data_key) if data_key is not None
+                    else record_decryptor(key, int(salt), scheme)
+                )
+            decrypt = decryptors[cache_key]
+            results.append({name: decrypt(value) for name, value in values.items()})
+        except Exception:
+            if not skip_failures:
+                raise
+            results.append(None)
+    return results
+
+
+def _build_jobs(
+    instances: list, keyring, skip_failures: bool, fields: list[str] = None
+) -> list[tuple | None]:
+    jobs = []
+    for instance in instances:
+        try:
+            data_key = keyring.data_key_for(instance)
+        except Exception:
+            if not skip_failures:
+                raise
+            jobs.append(None)
+            continue
+        values = instance._encrypted_values()
+        if fields is not None:
+            values = {name: value for name, value in values.items() if name in fields}
+        jobs.append((keyring.key, instance.salt, instance.scheme, data_key, values))
+    return jobs
+
+
+def _eager_fields(instances: list, fields: list[str] | None) -> list[str] | None:
+    '''The fields to decrypt up front: `fields`, plus any that cannot be deferred - and at least one,
+    so a record under another key is still caught here rather than when it is read'''
+    if fields is None or not instances:
+        return None
+    lazy = instances[0]._lazy_field_names()
+    eager = [
+        name for name in instances[0]._encrypted_field_names() if name in fields or name not in lazy
+    ]
+    return eager or lazy[:1]
+
+
+def _apply_results(instances: list, results, keyring=None, fields: list[str] = None) -> list:
+    decrypted = []
+    for instance, values in zip(instances, results):
+        if values is not None:
+            instance._set_values(values)
+            if fields is not None:
+                pending = [name for name in instance._lazy_field_names() if name not in values]
+                instance.defer_decryption(_deferred(keyring, instance), pending)
+            decrypted.append(instance)
+    return decrypted
+
+
+def _deferred(keyring, instance):
+    # the key is only derived if one of the deferred fields is read
+    return lambda value: keyring.decryptor(instance)(value)
+
+
+class DecryptionExecutor:
+    '''Decrypts many records at once, serially or fanned out over a thread or process pool
+
+    Results are applied in input order, and the first record (in input order) that fails to decrypt
+    raises - exactly as a serial loop would - unless `skip_failures` is set, in which case those
+    records are left out of the result instead. Envelopes are unwrapped up front in this process,
+    so workers only ever see per-record work.
+    '''
+    MODES = ('serial', 'thread', 'process')
+
+    def __init__(self, mode: str = 'serial', max_workers: int = None):
+        if mode not in self.MODES:
+            raise ValueError(f'mode must be one of {self.MODES}')
+        self.mode = mode
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._pool: Executor | None = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self) -> Executor:
+        # pools are expensive to start, so keep one for the life of the process
+        with self._lock:
+            if self._pool is None:
+                pool_class = ProcessPoolExecutor if self.mode == 'process' else ThreadPoolExecutor
+                self._pool = pool_class(max_workers=self.max_workers)
+            return self._pool
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+    def decrypt_all(
+        self, instances: list, keyring, skip_failures: bool = False, fields: list[str] = None
+    ) -> list:
+        '''With `fields`, only those are decrypted here - the records' other EncryptedTextFields are
+        left to decrypt on first access, so fields that are never read cost nothing'''
+        fields = _eager_fields(instances, fields)
+        jobs = _build_jobs(instances, keyring, skip_failures, fields)
+
+        if self.mode == 'serial' or len(jobs) < 2:
+            results = _decrypt_jobs(jobs, skip_failures)
+        else:
+            # batch jobs up so inter-process overhead (and each key derivation) is paid per chunk
+            # rather than per record
+            size = max(1, len(jobs) // (self.max_workers * 4))
+            chunks = [jobs[i:i + size] for i in range(0, len(jobs), size)]
+            decrypt = partial(_decrypt_jobs, skip_failures=skip_failures)
+            results = (result for chunk in self._get_pool().map(decrypt, chunks) for result in chunk)
+
+        return _apply_results(instances, results, keyring, fields)
+
+
+_executor: DecryptionExecutor | None = None
+
+
+def get_decryption_executor() -> DecryptionExecutor:
+    '''The process-wide executor configured by ENCRYPTION_DECRYPT_EXECUTOR'''
+    global _executor
+    if _executor is None:
+        _executor = DecryptionExecutor(**settings.ENCRYPTION_DECRYPT_EXECUTOR)
+    return _executor
+
+
+_crypto_executor: Executor | None = None
+_crypto_executor_lock = threading.Lock()
+
+
+def get_crypto_executor() -> Executor:
+    '''The bounded pool async views push CPU-bound crypto to, configured by ENCRYPTION_ASYNC_EXECUTOR
+
+    Only plain functions from app.encryption (and the jobs above) are sent to it, so it works with
+    both threads and processes.
+    '''
+    global _crypto_executor
+    with _crypto_executor_lock:
+        if _crypto_executor is None:
+            config = settings.ENCRYPTION_ASYNC_EXECUTOR
+            pool_class = ProcessPoolExecutor if config['mode'] == 'process' else ThreadPoolExecutor
+            _crypto_executor = pool_class(max_workers=config.get('max_workers'))
+        return _crypto_executor
+
+
+async def run_crypto(func, *args):
+    '''Run `func(*args)` on the crypto executor without blocking the event loop'''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_crypto_executor(), partial(func, *args))
+
+
+async def adecrypt_all(instances: list, keyring, skip_failures: bool = False) -> list:
+    '''DecryptionExecutor.decrypt_all for async views - every key derivation runs on the crypto
+    executor, never on the event loop'''
+    for envelope in keyring.missing_envelopes(instances):
+        try:
+            data_key = await run_crypto(
+                unwrap_data_key, keyring.key, int(envelope.salt), envelope.wrapped_key,
+                envelope.scheme,
+            )
+        except Exception:
+            if not skip_failures:
+                raise
+            data_key = None
+        keyring.set_data_key(envelope.id, data_key)
+
+    jobs = _build_jobs(instances, keyring, skip_failures)
+    results = await run_crypto(_decrypt_jobs, jobs, skip_failures)
+    return _apply_results(instances, results)
@@ -0,0 +1,51 @@
+from django.db import models
+from django.db.models.query_utils import DeferredAttribute
+
+
+class PendingDecryption:
+    '''The fields of a record still holding ciphertext, and how to decrypt them'''
+    def __init__(self, decrypt, fields):
+        self.decrypt = decrypt
+        self.fields = set(fields)
+
+
+class EncryptedFieldDescriptor(DeferredAttribute):
+    '''Decrypts the stored value on first access, when the record was decrypted lazily
+
+    A data descriptor (it defines __set__), so that reads go through __get__ even once the value is
+    in the instance __dict__.
+    '''
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+
+        pending = instance.__dict__.get('_pending_decryption')
+        if pending is not None and self.field.attname in pending.fields:
+            value = pending.decrypt(instance.__dict__[self.field.attname])  # let errors raise
+            instance.__dict__[self.field.attname] = value
+            pending.fields.discard(self.field.attname)
+
+        return super().__get__(instance, cls)
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+        # an assigned value is never ciphertext waiting to be decrypted
+        pending = instance.__dict__.get('_pending_decryption')
+        if pending is not None:
+            pending.fields.discard(self.field.attname)
+
+
+class EncryptedTextField(models.TextField):
+    '''TextField for use on an EncryptedMixin subclass - supports on-access decryption'''
+    descriptor_class = EncryptedFieldDescriptor
+
+
+class BlindIndexField(models.CharField):
+    '''Indexed keyed digest of another field's plaintext - see EncryptedMixin.blind_index_fields'''
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('max_length', 32)
+        kwargs.setdefault('null', True)
+        kwargs.setdefault('db_index', True)
+        kwargs.setdefault('editable', False)
+        super().__init__(*args, **kwargs)
@@ -0,0 +1,44 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.backup import check_file, import_from_file
+
+
+class Command(BaseCommand):
+    help = (
+        'Load a file written by export_messages. Each chunk is checked against its checksum before '
+        'it is inserted, and committed on its own.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File written by export_messages')
+        parser.add_argument(
+            '--ignore-conflicts', action='store_true',
+            help='Skip rows that already exist, e.g. to finish an interrupted import',
+        )
+        parser.add_argument(
+            '--check', action='store_true', help='Only verify the file - nothing is imported',
+        )
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        try:
+            if options['check']:
+                totals = check_file(options['path'])
+            else:
+                totals = import_from_file(options['path'], options['ignore_conflicts'])
+        except (OSError, ValueError) as error:
+            # chunks before the bad one are already in - fix the file, then re-run with
+            # --ignore-conflicts (or run --check first next time)
+            raise CommandError(f'{options["path"]}: {error}')
+        elapsed = time.monotonic() - started
+
+        for label, count in totals.items():
+            self.stdout.write(f'{label}: {count} rows')
+        rows = sum(totals.values())
+        verb = 'Verified' if options['check'] else 'Imported'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {rows} rows from {options["path"]} in {elapsed:.1f}s '
+            f'({rows / max(elapsed, 1e-9):,.0f} rows/s)'
+        ))
@@ -0,0 +1,348 @@
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from cryptography.fernet import InvalidToken
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F
+
+from app.encryption import (
+    SCHEMES, blind_index, decrypt_record_with_data_key, derive_lookup_key,
+    encrypt_record_with_data_key, key_check_tag, record_key, unwrap_key, wrap_data_key, wrap_key,
+)
+from app.models import (
+    Conversation, EncryptedChunk, KeyEnvelope, Message, MessageEncrypted, RekeyCheckpoint, Sequence,
+    _random_salt, get_lookup_key, get_write_scheme,
+)
+
+
+def _rekey_job(job: tuple) -> list[dict[str, str] | None]:
+    '''Decrypt a chunk of rows under the old key and re-encrypt them under the new one
+
+    Module-level and plain tuples in/out, so it can be pickled to worker processes. Rows with their
+    own salt are re-encrypted together under one fresh salt, so the new key is derived once per
+    chunk; envelope rows keep their data key. Rows that do not decrypt (or are None, because their
+    envelope could not be opened) come back as None.
+
+    A salted row's body key is rewrapped under its new record key. A body from before body keys
+    was encrypted under the old record key itself - that key becomes its body key, so the chunks
+    never need re-encrypting. Envelope rows keep their data key, so their bodies are untouched.
+
+    Each result also carries the row's conversation pair key under the new passphrase.
+    '''
+    old_key, new_key, new_scheme, lookup_key, blind_index_fields, rows = job
+    old_keys = {}  # rows written in bulk share a salt, so derive each old key once
+    plaintexts = []
+    for row in rows:
+        if row is None:
+            plaintexts.append(None)
+            continue
+        salt, scheme, data_key, values, _ = row
+        try:
+            if data_key is not None:
+                plaintexts.append(decrypt_record_with_data_key(data_key, values))
+                continue
+            if (salt, scheme) not in old_keys:
+                old_keys[salt, scheme] = record_key(old_key, int(salt), scheme)
+            plaintexts.append(decrypt_record_with_data_key(old_keys[salt, scheme], values))
+        except Exception:
+            plaintexts.append(None)
+
+    new_salt = _random_salt()
+    if any(plaintext is not None and row[2] is None for row, plaintext in zip(rows, plaintexts)):
+        new_record_key = record_key(new_key, new_salt, new_scheme)
+
+    results = []
+    for row, plaintext in zip(rows, plaintexts):
+        if plaintext is None:
+            results.append(None)
+            continue
+        salt, scheme, data_key, _, body_key = row
+        if data_key is not None:  # envelope row
+            values = encrypt_record_with_data_key(data_key, plaintext, new_scheme)
+            salt = ''
+        else:
+            values, salt = encrypt_record_with_data_key(new_record_key, plaintext, new_scheme), new_salt
+            if body_key is not None:
+                old_record_key = old_keys[row[0], row[1]]
+                stream_key = unwrap_key(old_record_key, body_key) if body_key else old_record_key
+                values['body_key'] = wrap_key(new_record_key, stream_key, new_scheme)
+        lookups = {
+            f'{field}_bidx': blind_index(lookup_key, field, plaintext[field])
+            for field in blind_index_fields
+        }
+        pair_key = Conversation.pair_key_for((plaintext['user_from'], plaintext['user_to']), lookup_key)
+        results.append({**values, **lookups, 'salt': salt, 'pair_key': pair_key})
+    return results
+
+
+class Command(BaseCommand):
+    help = (
+        'Re-encrypt messages written with one passphrase under another passphrase and/or scheme. '
+        'Rows are processed in batches in the order they were sent, with progress saved after '
+        'every batch so an interrupted run picks up where it left off.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--old-key', default=os.environ.get('REKEY_OLD_KEY'),
+            help='Current passphrase (default: $REKEY_OLD_KEY)',
+        )
+        parser.add_argument(
+            '--new-key', default=os.environ.get('REKEY_NEW_KEY'),
+            help='New passphrase (default: $REKEY_NEW_KEY, or the old passphrase to only change scheme)',
+        )
+        parser.add_argument(
+            '--scheme', type=int, choices=sorted(SCHEMES),
+            help='Scheme to re-encrypt with (default: ENCRYPTION_SCHEME)',
+        )
+        parser.add_argument(
+            '--old-pepper', default=os.environ.get('REKEY_OLD_PEPPER'),
+            help='The ENCRYPTION_LOOKUP_PEPPER rows were written under, if it has changed since - '
+                 'with the same passphrase, this only re-tags them (default: $REKEY_OLD_PEPPER)',
+        )
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--mode', choices=('serial', 'thread', 'process'), default='process')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument(
+            '--rows-per-second', type=float, default=0,
+            help='Upper bound on throughput, to leave room for live traffic (default: unthrottled)',
+        )
+        parser.add_argument('--checkpoint', default='rekey_messages', help='Name to save progress under')
+        parser.add_argument(
+            '--restart', action='store_true', help='Ignore any saved progress and start from the top',
+        )
+
+    def handle(self, *args, **options):
+        old_key = options['old_key']
+        new_key = options['new_key'] or old_key
+        if not old_key:
+            raise CommandError('Pass --old-key or set REKEY_OLD_KEY')
+        if options['batch_size'] < 1 or options['workers'] < 1:
+            raise CommandError('--batch-size and --workers must be at least 1')
+
+        self.old_key, self.new_key = old_key, new_key
+        self.scheme = options['scheme'] or get_write_scheme()
+        if options['old_pepper']:
+            self.old_lookup_key = derive_lookup_key(old_key, options['old_pepper'])
+        else:
+            self.old_lookup_key = get_lookup_key(old_key)
+        self.new_lookup_key = get_lookup_key(new_key)
+        self.data_keys = {}  # envelope id -> data key, or None if neither passphrase opens it
+        self.stale_envelopes = set()  # ids of envelopes still to be rewrapped
+
+        checkpoint = self._checkpoint(options['checkpoint'], options['restart'])
+        if checkpoint.last_sequence is not None:
+            self.stdout.write(
+                f'Resuming after message {checkpoint.last_sequence} ({checkpoint.rekeyed} rekeyed, '
+                f'{checkpoint.skipped} skipped so far)'
+            )
+
+        pool = self._pool(options['mode'], options['workers'])
+        try:
+            self._run(checkpoint, pool, options)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        checkpoint.delete()
+        self.stdout.write(self.style.SUCCESS(
+            f'Rekeyed {checkpoint.rekeyed} messages ({checkpoint.skipped} could not be decrypted '
+            f'with the old passphrase and were left as they were)'
+        ))
+
+    def _checkpoint(self, name: str, restart: bool) -> RekeyCheckpoint:
+        tags = {
+            'old_key_tag': key_check_tag(self.old_lookup_key),
+            'new_key_tag': key_check_tag(self.new_lookup_key),
+        }
+        checkpoint = RekeyCheckpoint.objects.filter(name=name).first()
+        if checkpoint is not None and not restart:
+            if (checkpoint.old_key_tag, checkpoint.new_key_tag) != tuple(tags.values()):
+                raise CommandError(
+                    f'Checkpoint {name!r} belongs to a run with different passphrases - '
+                    f'pass --restart to discard it, or --checkpoint to use another name'
+                )
+            return checkpoint
+        RekeyCheckpoint.objects.filter(name=name).delete()
+        return RekeyCheckpoint.objects.create(name=name, **tags)
+
+    @staticmethod
+    def _pool(mode: str, workers: int) -> Executor | None:
+        if mode == 'serial' or workers == 1:
+            return None
+        pool_class = ProcessPoolExecutor if mode == 'process' else ThreadPoolExecutor
+        return pool_class(max_workers=workers)
+
+    def _run(self, checkpoint: RekeyCheckpoint, pool: Executor | None, options: dict):
+        # rows already moved to a new passphrase drop out of this filter, so re-running is safe.
+        # Sequences only grow, so messages sent while the command runs are reached as well.
+        queryset = MessageEncrypted.objects.filter(
+            MessageEncrypted.key_tag_filter(self.old_lookup_key)
+        ).select_related('envelope').annotate(sequence=F('message__sequence')).order_by('sequence')
+        rate = options['rows_per_second']
+        started, processed = time.monotonic(), 0
+
+        while True:
+            batch = list(queryset.filter(
+                sequence__gt=checkpoint.last_sequence or 0
+            )[:options['batch_size']])
+            if not batch:
+                return
+
+            last_sequence, rows = batch[-1].sequence, batch
+            while rows:
+                # rows changed (a body stored) between being read and written are read again
+                changed = self._rekey(checkpoint, pool, rows, last_sequence, options['workers'])
+                rows = list(queryset.filter(id__in=changed))
+
+            processed += len(batch)
+            self.stdout.write(
+                f'{checkpoint.rekeyed} rekeyed, {checkpoint.skipped} skipped, '
+                f'up to message {checkpoint.last_sequence}'
+            )
+            if rate:
+                # sleep off any lead over the target rate, averaged over the whole run
+                time.sleep(max(0.0, started + processed / rate - time.monotonic()))
+
+    def _rekey(
+        self, checkpoint: RekeyCheckpoint, pool: Executor | None, batch: list, last_sequence: int,
+        workers: int,
+    ) -> list:
+        with_bodies = set(EncryptedChunk.objects.filter(
+            message__in=batch, index=0
+        ).values_list('message_id', flat=True))
+        rows = [self._row(instance, instance.id in with_bodies) for instance in batch]
+        # one job per worker, so each derives the new key once
+        chunk_size = -(-len(rows) // workers)
+        jobs = [
+            (self.old_key, self.new_key, self.scheme, self.new_lookup_key,
+             MessageEncrypted.blind_index_fields, rows[i:i + chunk_size])
+            for i in range(0, len(rows), chunk_size)
+        ]
+        results = [
+            result for chunk in (pool.map(_rekey_job, jobs) if pool else map(_rekey_job, jobs))
+            for result in chunk
+        ]
+        return self._save(checkpoint, batch, results, last_sequence)
+
+    def _row(self, instance: MessageEncrypted, has_body: bool) -> tuple | None:
+        body_key = instance.body_key if has_body else None
+        if instance.envelope_id is None:
+            return instance.salt, instance.scheme, None, instance._encrypted_values(), body_key
+        data_key = self._data_key(instance.envelope)
+        if data_key is None:
+            return None
+        return instance.salt, instance.scheme, data_key, instance._encrypted_values(), body_key
+
+    def _data_key(self, envelope: KeyEnvelope) -> bytes | None:
+        '''Envelopes are shared by many rows, so one may already have been rewrapped by an earlier
+        batch of an interrupted run - those open with the new passphrase instead'''
+        if envelope.id not in self.data_keys:
+            self.data_keys[envelope.id] = None
+            for key in (self.old_key, self.new_key):
+                try:
+                    self.data_keys[envelope.id] = envelope.unwrap(key)
+                except InvalidToken:
+                    continue
+                if key == self.old_key and (
+                    self.old_lookup_key != self.new_lookup_key or envelope.scheme != self.scheme
+                ):
+                    self.stale_envelopes.add(envelope.id)
+                break
+        return self.data_keys[envelope.id]
+
+    def _save(
+        self, checkpoint: RekeyCheckpoint, batch: list, results: list, last_sequence: int
+    ) -> list:
+        '''Write the rekeyed rows and the checkpoint, returning the ids of rows that changed since
+        they were read - those are left as they are, to be rekeyed again'''
+        read = {instance.id: (instance.salt, instance.body_key) for instance in batch}
+        rekeyed, pair_keys = [], {}
+        for instance, values in zip(batch, results):
+            if values is None:
+                continue
+            pair_keys[instance.id] = values.pop('pair_key')
+            instance._set_values(values)
+            instance.key_tag = key_check_tag(self.new_lookup_key)
+            instance.scheme = self.scheme
+            rekeyed.append(instance)
+
+        fields = [
+            'salt', 'key_tag', 'scheme', 'body_key', *batch[0]._encrypted_field_names(),
+            *(f'{field}_bidx' for field in MessageEncrypted.blind_index_fields),
+        ]
+        with transaction.atomic():
+            # locked until the rows are written, so a body stored meanwhile (see write_body) is
+            # never overwritten by a body key read before it
+            current = {
+                row_id: (salt, body_key)
+                for row_id, salt, body_key in MessageEncrypted.objects.select_for_update().filter(
+                    id__in=[instance.id for instance in rekeyed]
+                ).values_list('id', 'salt', 'body_key')
+            }
+            changed = [
+                instance.id for instance in rekeyed if current.get(instance.id) != read[instance.id]
+            ]
+            unchanged = [instance for instance in rekeyed if instance.id not in changed]
+
+            # envelopes are rewrapped in the same transaction as their first rows, so a crash never
+            # leaves rows readable under neither passphrase
+            stale = self.stale_envelopes & {instance.envelope_id for instance in unchanged}
+            for envelope_id in stale:
+                self._rewrap(envelope_id)
+            MessageEncrypted.objects.bulk_update(unchanged, fields)
+            self._move_conversations({
+                instance.id: pair_keys[instance.id] for instance in unchanged
+            })
+            checkpoint.last_sequence = last_sequence
+            checkpoint.rekeyed += len(unchanged)
+            checkpoint.skipped += len(batch) - len(rekeyed)
+            checkpoint.save()
+
+        self.stale_envelopes -= stale
+        return changed
+
+    def _move_conversations(self, pair_keys: dict):
+        '''Give the rows' conversations the pair key they have under the new passphrase (see
+        Conversation.pair_key_for), merging into any the pair already has under it'''
+        if settings.ENCRYPTION_CONVERSATION_PARTICIPANTS:
+            return  # found by their participants alone, whatever the passphrase
+        moves = {
+            conversation_id: pair_keys[encrypted_id]
+            for encrypted_id, conversation_id in Message.objects.filter(
+                encrypted__in=pair_keys, conversation__isnull=False,
+            ).values_list('encrypted_id', 'conversation_id')
+        }
+        for conversation in Conversation.objects.filter(id__in=moves):
+            pair_key = moves[conversation.id]
+            if conversation.pair_key == pair_key:
+                continue
+            if (into := Conversation.objects.filter(pair_key=pair_key).first()) is None:
+                conversation.pair_key = pair_key
+                conversation.save(update_fields=['pair_key'])
+            else:
+                self._merge_conversation(conversation, into)
+
+    @staticmethod
+    def _merge_conversation(conversation: Conversation, into: Conversation):
+        '''Move a conversation's messages into another, numbering them all afresh in the order
+        they were sent'''
+        messages = Message.objects.filter(conversation__in=[conversation, into])
+        messages = list(messages.order_by('sequence').only('id'))
+        first = Sequence.allocate(into.sequence_name, len(messages))
+        for offset, message in enumerate(messages):
+            message.conversation, message.conversation_sequence = into, first + offset
+        Message.objects.bulk_update(messages, ['conversation', 'conversation_sequence'])
+        conversation.delete()
+        Sequence.objects.filter(name=conversation.sequence_name).delete()
+
+    def _rewrap(self, envelope_id):
+        '''Wrap the envelope's data key under the new passphrase and scheme'''
+        salt = _random_salt()
+        KeyEnvelope.objects.filter(id=envelope_id).update(
+            salt=salt, scheme=self.scheme, key_tag=key_check_tag(self.new_lookup_key),
+            wrapped_key=wrap_data_key(self.new_key, salt, self.data_keys[envelope_id], self.scheme),
+        )
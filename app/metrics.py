@@ -0,0 +1,178 @@
+'''Timers and counters for the crypto and request hot paths
+
+Instrumented functions check a single module flag before doing anything else, so while metrics are
+off (the default) the overhead is one global lookup per call. When on, every measurement goes to:
+
+- the configured sink, if any - aggregated for the life of the process, and
+- the current request's timings, if it is being collected for a Server-Timing header.
+
+Work done on worker processes (the process pools in app.executors) is measured in those processes,
+so it is not seen here - only the time the caller spent waiting for it.
+'''
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+
+class InMemorySink:
+    '''Totals and call counts per timer, and totals per counter, kept in memory'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timers: dict[str, list] = {}  # name -> [total seconds, count]
+        self.counters: dict[str, int] = {}
+
+    def timing(self, name: str, seconds: float):
+        with self._lock:
+            timer = self.timers.setdefault(name, [0.0, 0])
+            timer[0] += seconds
+            timer[1] += 1
+
+    def increment(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'timers': {name: tuple(timer) for name, timer in self.timers.items()},
+                'counters': dict(self.counters),
+            }
+
+    def reset(self):
+        with self._lock:
+            self.timers.clear()
+            self.counters.clear()
+
+
+class LogSink:
+    '''Every measurement as a DEBUG line on the app.metrics logger'''
+
+    def timing(self, name: str, seconds: float):
+        logger.debug('%s took %.3fms', name, seconds * 1000)
+
+    def increment(self, name: str, value: int = 1):
+        logger.debug('%s +%d', name, value)
+
+
+class PrometheusSink(InMemorySink):
+    '''InMemorySink that can render itself in the Prometheus text format, for scraping'''
+    prefix = 'encrypted_db'
+
+    def _metric_name(self, name: str) -> str:
+        return f'{self.prefix}_{name}'.replace('.', '_').replace('-', '_')
+
+    def render(self) -> str:
+        snapshot = self.snapshot()
+        lines = []
+        for name, (total, count) in sorted(snapshot['timers'].items()):
+            metric = self._metric_name(name) + '_seconds'
+            lines += [
+                f'# TYPE {metric} summary',
+                f'{metric}_sum {total!r}',
+                f'{metric}_count {count}',
+            ]
+        for name, value in sorted(snapshot['counters'].items()):
+            metric = self._metric_name(name) + '_total'
+            lines += [f'# TYPE {metric} counter', f'{metric} {value}']
+        return '\n'.join(lines) + '\n'
+
+
+SINKS = {'memory': InMemorySink, 'log': LogSink, 'prometheus': PrometheusSink}
+
+_enabled = False
+_sink = None
+_server_timing = False
+_request_timings: ContextVar[dict | None] = ContextVar('request_timings', default=None)
+
+
+def configure_metrics(sink=None, server_timing: bool = False):
+    '''Start measuring. `sink` is a sink instance or a name from SINKS'''
+    global _enabled, _sink, _server_timing
+    if isinstance(sink, str):
+        sink = SINKS[sink]()
+    _sink = sink
+    _server_timing = server_timing
+    _enabled = sink is not None or server_timing
+    return sink
+
+
+def disable_metrics():
+    global _enabled, _sink, _server_timing
+    _enabled, _sink, _server_timing = False, None, False
+
+
+def get_metrics_sink():
+    return _sink
+
+
+def server_timing_enabled() -> bool:
+    return _server_timing
+
+
+def record(name: str, seconds: float):
+    if _sink is not None:
+        _sink.timing(name, seconds)
+    timings = _request_timings.get()
+    if timings is not None:
+        timing = timings.setdefault(name, [0.0, 0])
+        timing[0] += seconds
+        timing[1] += 1
+
+
+def increment(name: str, value: int = 1):
+    if _enabled and _sink is not None:
+        _sink.increment(name, value)
+
+
+def timed(name: str):
+    '''Decorator timing every call of the function as `name`'''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def phase(name: str):
+    '''Time a block, e.g. one phase of a view'''
+    if not _enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+@contextmanager
+def collect_request_timings():
+    '''Collect everything measured inside the block (in this thread or task) into the yielded dict'''
+    timings = {}
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+
+def server_timing_header(timings: dict) -> str:
+    '''name -> [total seconds, count] as a Server-Timing header value'''
+    return ', '.join(
+        f'{name};dur={total * 1000:.2f};desc="{count} call{"s" if count != 1 else ""}"'
+        for name, (total, count) in timings.items()
+    )
@@ -0,0 +1,40 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import StreamingHttpResponse
+
+from . import metrics
+
+
+class ServerTimingMiddleware:
+    '''Report where each request's time went (see app.metrics) in a Server-Timing header
+
+    Only active when ENCRYPTION_METRICS enables server_timing - otherwise Django drops it at startup.
+    Streamed responses send their headers before the work is done, so get no header.
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not metrics.server_timing_enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with metrics.collect_request_timings() as timings:
+            response = self.get_response(request)
+        return self._add_header(response, timings)
+
+    async def __acall__(self, request):
+        with metrics.collect_request_timings() as timings:
+            response = await self.get_response(request)
+        return self._add_header(response, timings)
+
+    @staticmethod
+    def _add_header(response, timings: dict):
+        if timings and not isinstance(response, StreamingHttpResponse):
+            response['Server-Timing'] = metrics.server_timing_header(timings)
+        return response
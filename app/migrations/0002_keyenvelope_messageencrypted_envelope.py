@@ -0,0 +1,30 @@
+# Generated by Django 5.1.4 on 2026-10-18 08:02
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KeyEnvelope',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, primary_key=True, serialize=False)),
+                ('salt', models.CharField(max_length=32)),
+                ('wrapped_key', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('owner', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='key_envelopes', to='app.appuser')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='messageencrypted',
+            name='envelope',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='app.keyenvelope'),
+        ),
+    ]
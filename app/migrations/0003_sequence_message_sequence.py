@@ -0,0 +1,42 @@
+from django.db import migrations, models
+
+
+def backfill_sequence(apps, schema_editor):
+    # created_at may be encrypted, so the original order cannot be recovered - number existing
+    # messages in primary key order, ahead of anything created from now on
+    Message = apps.get_model('app', 'Message')
+    Sequence = apps.get_model('app', 'Sequence')
+
+    value = 0
+    for message in Message.objects.order_by('pk').only('pk').iterator():
+        value += 1
+        Message.objects.filter(pk=message.pk).update(sequence=value)
+    Sequence.objects.create(name='message', value=value)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0002_keyenvelope_messageencrypted_envelope'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Sequence',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='sequence',
+            field=models.BigIntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_sequence, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='message',
+            name='sequence',
+            field=models.BigIntegerField(editable=False, unique=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.4 on 2026-10-18 08:06
+
+import app.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0003_sequence_message_sequence'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='messageencrypted',
+            name='content',
+            field=app.fields.EncryptedTextField(),
+        ),
+        migrations.AlterField(
+            model_name='messageencrypted',
+            name='created_at',
+            field=app.fields.EncryptedTextField(),
+        ),
+        migrations.AlterField(
+            model_name='messageencrypted',
+            name='user_from',
+            field=app.fields.EncryptedTextField(),
+        ),
+        migrations.AlterField(
+            model_name='messageencrypted',
+            name='user_to',
+            field=app.fields.EncryptedTextField(),
+        ),
+    ]
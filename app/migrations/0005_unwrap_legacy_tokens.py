@@ -0,0 +1,55 @@
+import base64
+
+from django.db import migrations
+
+ENCRYPTED_FIELDS = ['created_at', 'user_from', 'user_to', 'content']
+BATCH_SIZE = 1000
+
+# Copied rather than imported from app.encryption, so this migration keeps working as it changes
+LEGACY_TOKEN_PREFIX = 'Z0FBQUFB'  # base64 of a Fernet token's first bytes
+
+
+def is_legacy_token(value: str) -> bool:
+    return value.startswith(LEGACY_TOKEN_PREFIX)
+
+
+def from_legacy_token(value: str) -> str:
+    return base64.b64decode(value.encode('utf-8')).decode('utf-8')
+
+
+def _unwrap(Model, fields: list[str]):
+    # Unencrypted messages keep plaintext in the same columns, so only rewrite rows where every
+    # field is a double-encoded token
+    batch = []
+    for instance in Model.objects.only('pk', *fields).iterator(chunk_size=BATCH_SIZE):
+        values = [getattr(instance, field) for field in fields]
+        if not all(is_legacy_token(value) for value in values):
+            continue
+
+        for field, value in zip(fields, values):
+            setattr(instance, field, from_legacy_token(value))
+        batch.append(instance)
+
+        if len(batch) >= BATCH_SIZE:
+            Model.objects.bulk_update(batch, fields)
+            batch = []
+
+    if batch:
+        Model.objects.bulk_update(batch, fields)
+
+
+def unwrap_legacy_tokens(apps, schema_editor):
+    _unwrap(apps.get_model('app', 'MessageEncrypted'), ENCRYPTED_FIELDS)
+    _unwrap(apps.get_model('app', 'KeyEnvelope'), ['wrapped_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0004_encrypted_text_fields'),
+    ]
+
+    operations = [
+        # the reader accepts both formats, so there is nothing to undo
+        migrations.RunPython(unwrap_legacy_tokens, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.1.4 on 2026-10-18 08:09
+
+import app.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_unwrap_legacy_tokens'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messageencrypted',
+            name='user_from_bidx',
+            field=app.fields.BlindIndexField(db_index=True, editable=False, max_length=32, null=True),
+        ),
+        migrations.AddField(
+            model_name='messageencrypted',
+            name='user_to_bidx',
+            field=app.fields.BlindIndexField(db_index=True, editable=False, max_length=32, null=True),
+        ),
+    ]
@@ -0,0 +1,51 @@
+from django.db import migrations, models
+
+ENCRYPTED_FIELDS = ['created_at', 'user_from', 'user_to', 'content']
+BATCH_SIZE = 1000
+
+# As they were when this migration was written (see 0005): every encrypted value was then a Fernet
+# token, possibly still base64-encoded a second time.
+TOKEN_PREFIX = 'gAAAAA'
+LEGACY_TOKEN_PREFIX = 'Z0FBQUFB'  # base64 of TOKEN_PREFIX
+
+
+def _is_token(value: str) -> bool:
+    return value.startswith((TOKEN_PREFIX, LEGACY_TOKEN_PREFIX))
+
+
+def tag_unencrypted_rows(apps, schema_editor):
+    # Tags cannot be computed without the passphrase, so existing encrypted rows stay untagged
+    # (null). Rows that are plainly not encrypted can be marked as such, so keyed reads skip them.
+    MessageEncrypted = apps.get_model('app', 'MessageEncrypted')
+
+    batch = []
+    for instance in MessageEncrypted.objects.only('pk', *ENCRYPTED_FIELDS).iterator(BATCH_SIZE):
+        if not all(_is_token(getattr(instance, field)) for field in ENCRYPTED_FIELDS):
+            batch.append(instance.pk)
+        if len(batch) >= BATCH_SIZE:
+            MessageEncrypted.objects.filter(pk__in=batch).update(key_tag='')
+            batch = []
+
+    if batch:
+        MessageEncrypted.objects.filter(pk__in=batch).update(key_tag='')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_blind_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messageencrypted',
+            name='key_tag',
+            field=models.CharField(blank=True, db_index=True, max_length=16, null=True),
+        ),
+        migrations.AlterField(
+            model_name='messageencrypted',
+            name='key_tag',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=16, null=True),
+        ),
+        migrations.RunPython(tag_unencrypted_rows, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-18 08:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_messageencrypted_key_tag'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='keyenvelope',
+            name='scheme',
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='messageencrypted',
+            name='scheme',
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.1.4 on 2026-10-18 08:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_encryption_schemes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RekeyCheckpoint',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('old_key_tag', models.CharField(max_length=16)),
+                ('new_key_tag', models.CharField(max_length=16)),
+                ('last_id', models.UUIDField(null=True)),
+                ('rekeyed', models.BigIntegerField(default=0)),
+                ('skipped', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.1.4 on 2026-10-18 08:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_rekeycheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EncryptedChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='body_chunks', to='app.messageencrypted')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('message', 'index'), name='unique_chunk_index')],
+            },
+        ),
+    ]
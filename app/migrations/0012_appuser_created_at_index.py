@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 08:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0011_conversations'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='appuser',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0012_appuser_created_at_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messageencrypted',
+            name='body_key',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
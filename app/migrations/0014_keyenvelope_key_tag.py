@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 09:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0013_messageencrypted_body_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='keyenvelope',
+            name='key_tag',
+            field=models.CharField(blank=True, max_length=16, null=True),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.1.4 on 2026-10-18 10:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0014_keyenvelope_key_tag'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='rekeycheckpoint',
+            name='last_id',
+        ),
+        migrations.AddField(
+            model_name='rekeycheckpoint',
+            name='last_sequence',
+            field=models.BigIntegerField(null=True),
+        ),
+    ]
@@ -1,9 +1,34 @@
+import hashlib
 import os
 from uuid import uuid4
 
-from django.db import models
+from cryptography.fernet import InvalidToken
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import F
 
-from .encryption import decrypt_data, encrypt_data
+from .encryption import (
+    DEFAULT_SCHEME, blind_index, data_key_decryptor, decrypt_record, decrypt_record_with_data_key,
+    decrypt_stream, derive_lookup_key, encrypt_record, encrypt_record_with_data_key, encrypt_records,
+    encrypt_stream, generate_data_key, key_check_tag, record_decryptor, record_key, unwrap_data_key,
+    unwrap_key, wrap_data_key, wrap_key,
+)
+from .fields import BlindIndexField, EncryptedTextField, PendingDecryption
+from .metrics import timed
+
+
+def _random_salt() -> int:
+    return int.from_bytes(os.urandom(16), byteorder='big')
+
+
+def get_write_scheme() -> int:
+    '''The encryption scheme (see app.encryption.SCHEMES) new records are written with'''
+    return settings.ENCRYPTION_SCHEME
+
+
+def get_lookup_key(key: str) -> bytes:
+    '''The key for blind indexes - the same for every record written with this passphrase'''
+    return derive_lookup_key(key, settings.ENCRYPTION_LOOKUP_PEPPER)
 
 
 class EncryptedMixin(models.Model):
@@ -14,9 +39,27 @@ class EncryptedMixin(models.Model):
 
     As everything is base64 encoded, all fields on subclass **must** be strings. They can be 
     converted into their representative types using serializers.
+
+    Records are either encrypted with a key derived from the passphrase and their own salt, or -
+    when `envelope` is set - with the data key held (wrapped) by that envelope.
+
+    Subclasses can list fields in `blind_index_fields` to be able to look records up by those
+    fields' plaintext. Each needs a matching `<field>_bidx = BlindIndexField()`.
+
+    `key_tag` identifies the passphrase a record was written with (see `key_tag_filter`): '' for
+    unencrypted records, and null for records written before tags existed. `scheme` records the
+    KDF and cipher used, so records keep decrypting when the scheme for new writes changes.
     '''
+    blind_index_fields: tuple[str, ...] = ()
+    plaintext_fields = ('id', 'salt', 'key_tag', 'scheme')
+
     id = models.UUIDField(primary_key=True, default=uuid4)
     salt = models.CharField(max_length=32)  # 16-byte digit is too big for even BigIntegerField
+    envelope = models.ForeignKey(
+        'KeyEnvelope', null=True, blank=True, on_delete=models.PROTECT, related_name='+',
+    )
+    key_tag = models.CharField(max_length=16, null=True, blank=True, default='', db_index=True)
+    scheme = models.PositiveSmallIntegerField(default=DEFAULT_SCHEME)
 
     class Meta:
         abstract = True
@@ -24,55 +67,453 @@ class EncryptedMixin(models.Model):
     def _concrete_field_names(self) -> list[str]:
         return [field.name for field in self._meta.fields if not field.is_relation]
 
-    def encrypt(self, key: str = None):
+    def _encrypted_field_names(self) -> list[str]:
+        return [
+            field.name for field in self._meta.fields
+            if not field.is_relation and field.name not in self.plaintext_fields
+            and not isinstance(field, BlindIndexField)
+        ]
+
+    def _encrypted_values(self) -> dict[str, str]:
+        return {field: str(getattr(self, field)) for field in self._encrypted_field_names()}
+
+    def _set_values(self, values: dict[str, str]):
+        for field, value in values.items():
+            setattr(self, field, value)
+
+    def _lazy_field_names(self) -> list[str]:
+        return [
+            field for field in self._encrypted_field_names()
+            if isinstance(self._meta.get_field(field), EncryptedTextField)
+        ]
+
+    def defer_decryption(self, decrypt, fields: list[str]):
+        '''Leave `fields` (EncryptedTextFields) holding ciphertext, each passed through `decrypt`
+        when it is first read'''
+        self.__dict__['_pending_decryption'] = PendingDecryption(decrypt, fields)
+
+    def _set_lookups(self, lookup_key: bytes):
+        self.key_tag = key_check_tag(lookup_key)
+        for field in self.blind_index_fields:
+            setattr(self, f'{field}_bidx', blind_index(lookup_key, field, str(getattr(self, field))))
+
+    @classmethod
+    def blind_index_lookups(cls, lookup_key: bytes, **values) -> dict[str, str]:
+        '''Filter kwargs matching records whose plaintext fields equal `values`'''
+        lookups = {}
+        for field, value in values.items():
+            if field not in cls.blind_index_fields:
+                raise ValueError(f'{field} has no blind index')
+            lookups[f'{field}_bidx'] = blind_index(lookup_key, field, str(value))
+        return lookups
+
+    @classmethod
+    def key_tag_filter(cls, lookup_key: bytes, prefix: str = '') -> models.Q:
+        '''Records that may have been written with this key - tagged with it, or untagged'''
+        return (
+            models.Q(**{f'{prefix}key_tag': key_check_tag(lookup_key)})
+            | models.Q(**{f'{prefix}key_tag__isnull': True})
+        )
+
+    @timed('record.encrypt')
+    def encrypt(self, key: str = None, lookup_key: bytes = None):
         if key is None:
             return self  # assume already encrypted
 
         # generate random salt
-        self.salt = int.from_bytes(os.urandom(16), byteorder='big')
+        self.salt = _random_salt()
+
+        self._set_lookups(lookup_key or get_lookup_key(key))
+
+        # all fields share the key and salt, so encrypt them together -> one key derivation per row
+        self.scheme = get_write_scheme()
+        self._set_values(
+            encrypt_record(key, int(self.salt), self._encrypted_values(), self.scheme)
+        )
+        return self
+
+    @classmethod
+    @timed('record.encrypt_many')
+    def encrypt_many(
+        cls, instances: list['EncryptedMixin'], key: str, lookup_key: bytes = None
+    ) -> list['EncryptedMixin']:
+        '''Encrypt a batch under one new salt, so the key is derived once for the whole batch'''
+        salt = _random_salt()
+        lookup_key = lookup_key or get_lookup_key(key)
+        for instance in instances:
+            instance._set_lookups(lookup_key)
+
+        values = [instance._encrypted_values() for instance in instances]
+        scheme = get_write_scheme()
+        encrypted = encrypt_records(key, salt, values, scheme)
+        for instance, values in zip(instances, encrypted):
+            instance.salt = salt
+            instance.scheme = scheme
+            instance._set_values(values)
+        return instances
 
-        for field in self._concrete_field_names():
-            if field in ('id', 'salt'):
-                continue
+    @timed('record.encrypt')
+    def encrypt_with_envelope(self, envelope: 'KeyEnvelope', data_key: bytes, lookup_key: bytes):
+        '''`lookup_key` is the passphrase's (see get_lookup_key) - the data key alone cannot tag the
+        record or fill its blind indexes'''
+        self.envelope = envelope
+        self.salt = ''  # the envelope holds the salt
 
-            value = str(getattr(self, field))
-            encrypted = encrypt_data(key, int(self.salt), value)
-            setattr(self, field, encrypted)
+        self._set_lookups(lookup_key)
 
+        self.scheme = get_write_scheme()  # only the cipher applies - the envelope did the KDF
+        self._set_values(
+            encrypt_record_with_data_key(data_key, self._encrypted_values(), self.scheme)
+        )
         return self
 
-    def decrypt(self, key: str = None):
-        if key is None:
+    @timed('record.decrypt')
+    def decrypt(self, key: str = None, data_key: bytes = None, lazy: bool = False):
+        '''Pass `data_key` for envelope records to avoid unwrapping the envelope again
+
+        With `lazy`, EncryptedTextFields are only decrypted when first read, so callers that touch
+        a few fields of many records only pay for those. A wrong key then raises on that first read.
+        '''
+        if key is None and data_key is None:
             return self  # assume already decrypted
 
-        for field in self._concrete_field_names():
-            if field in ('id', 'salt'):
-                continue
+        if self.envelope_id is not None and data_key is None:
+            data_key = self.envelope.unwrap(key)
 
-            value = str(getattr(self, field))
-            decrypted = decrypt_data(key, int(self.salt), value)  # let errors raise
-            setattr(self, field, decrypted)
+        if lazy:
+            if data_key is not None:
+                decrypt = data_key_decryptor(data_key)
+            else:
+                decrypt = record_decryptor(key, int(self.salt), self.scheme)
+            lazy_fields = self._lazy_field_names()
+            self.defer_decryption(decrypt, lazy_fields)
+            # plain TextFields have no descriptor to defer to, so decrypt those now
+            for field in self._encrypted_field_names():
+                if field not in lazy_fields:
+                    setattr(self, field, decrypt(str(getattr(self, field))))
+            return self
 
+        if data_key is not None:
+            decrypted = decrypt_record_with_data_key(data_key, self._encrypted_values())
+        else:
+            decrypted = decrypt_record(
+                key, int(self.salt), self._encrypted_values(), self.scheme
+            )
+
+        self._set_values(decrypted)  # let errors raise before anything is modified
         return self
 
+    def stream_key(self, key: str, data_key: bytes = None) -> bytes:
+        '''Key material for this record's streamed data (see app.encryption.encrypt_stream)
+
+        Checked against one of the record's fields first, so a wrong passphrase raises InvalidToken
+        here rather than part way through a stream.
+        '''
+        if self.envelope_id is not None:
+            key_material = data_key or self.envelope.unwrap(key)
+        else:
+            key_material = record_key(key, int(self.salt), self.scheme)
+        data_key_decryptor(key_material)(next(iter(self._encrypted_values().values())))
+        return key_material
+
 
 class AppUser(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid4)
     name = models.CharField(max_length=20)  # something I can use to recognise users
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)  # the list's page order
     
     def __str__(self):
         return self.name
 
 
+class KeyEnvelope(models.Model):
+    '''A random data key, stored wrapped by the key derived from a user's passphrase
+
+    Records encrypted under the data key only need the passphrase to be stretched once to unwrap
+    it, however many records are read.
+    '''
+    id = models.UUIDField(primary_key=True, default=uuid4)
+    owner = models.ForeignKey(
+        AppUser, null=True, on_delete=models.SET_NULL, related_name='key_envelopes',
+    )
+    salt = models.CharField(max_length=32)
+    wrapped_key = models.TextField()
+    scheme = models.PositiveSmallIntegerField(default=DEFAULT_SCHEME)
+    # The passphrase's key_check_tag, so its envelope is found without unwrapping the owner's
+    # others. Null for envelopes from before tags.
+    key_tag = models.CharField(max_length=16, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def unwrap(self, key: str) -> bytes:
+        return unwrap_data_key(key, int(self.salt), self.wrapped_key, self.scheme)
+
+    @classmethod
+    def create_for(cls, owner_id, key: str, lookup_key: bytes = None) -> tuple['KeyEnvelope', bytes]:
+        data_key = generate_data_key()
+        salt = _random_salt()
+        scheme = get_write_scheme()
+        envelope = cls.objects.create(
+            owner_id=owner_id, salt=salt, scheme=scheme,
+            key_tag=key_check_tag(lookup_key or get_lookup_key(key)),
+            wrapped_key=wrap_data_key(key, salt, data_key, scheme),
+        )
+        return envelope, data_key
+
+    @classmethod
+    def candidates(cls, owner_id, lookup_key: bytes) -> models.QuerySet:
+        '''The owner's envelopes that may be wrapped under this passphrase: the one tagged with it,
+        then any untagged, newest first'''
+        return cls.objects.filter(
+            models.Q(key_tag=key_check_tag(lookup_key)) | models.Q(key_tag__isnull=True),
+            owner_id=owner_id,
+        ).order_by(F('key_tag').asc(nulls_last=True), '-created_at')
+
+    @classmethod
+    def open_for(cls, owner_id, key: str, lookup_key: bytes = None) -> tuple['KeyEnvelope', bytes]:
+        '''The owner's envelope for this passphrase, created on first use'''
+        lookup_key = lookup_key or get_lookup_key(key)
+        for envelope in cls.candidates(owner_id, lookup_key):
+            try:
+                data_key = envelope.unwrap(key)
+            except InvalidToken:
+                continue  # untagged, and wrapped under another passphrase
+            if envelope.key_tag is None:  # tag it, so it is the only one tried from now on
+                envelope.key_tag = key_check_tag(lookup_key)
+                envelope.save(update_fields=['key_tag'])
+            return envelope, data_key
+        return cls.create_for(owner_id, key, lookup_key)
+
+
+class Keyring:
+    '''A passphrase, plus everything derived from it so far
+
+    Each envelope is unwrapped at most once - including failed attempts, so rows under another
+    passphrase do not each cost a key derivation.
+    '''
+    def __init__(self, key: str, lookup_key: bytes = None):
+        self.key = key
+        self._data_keys: dict = {}
+        self._failed: set = set()
+        self._decryptors: dict = {}
+        self._lookup_key = lookup_key
+
+    @property
+    def lookup_key(self) -> bytes:
+        if self._lookup_key is None:
+            self._lookup_key = get_lookup_key(self.key)
+        return self._lookup_key
+
+    def data_key(self, envelope: KeyEnvelope) -> bytes:
+        if envelope.id in self._failed:
+            raise InvalidToken
+        if envelope.id not in self._data_keys:
+            try:
+                self._data_keys[envelope.id] = envelope.unwrap(self.key)
+            except InvalidToken:
+                self._failed.add(envelope.id)
+                raise
+        return self._data_keys[envelope.id]
+
+    def set_data_key(self, envelope_id, data_key: bytes | None):
+        '''Record an envelope unwrapped elsewhere (None if it could not be)'''
+        if data_key is None:
+            self._failed.add(envelope_id)
+        else:
+            self._data_keys[envelope_id] = data_key
+
+    def missing_envelopes(self, instances: list[EncryptedMixin]) -> list[KeyEnvelope]:
+        '''Envelopes of these records that have not been tried yet'''
+        missing = {}
+        for instance in instances:
+            envelope_id = instance.envelope_id
+            if envelope_id is not None and envelope_id not in self._data_keys \
+                    and envelope_id not in self._failed:
+                missing[envelope_id] = instance.envelope
+        return list(missing.values())
+
+    def data_key_for(self, instance: EncryptedMixin) -> bytes | None:
+        '''None for records encrypted with their own salt'''
+        if instance.envelope_id is None:
+            return None
+        # check the id first so a cached data key never needs the envelope fetching
+        return self._data_keys.get(instance.envelope_id) or self.data_key(instance.envelope)
+
+    def decryptor(self, instance: EncryptedMixin):
+        '''A single-value decryptor for `instance`, shared by every record under the same key'''
+        data_key = self.data_key_for(instance)
+        cache_key = data_key if data_key is not None else (instance.salt, instance.scheme)
+        if cache_key not in self._decryptors:
+            self._decryptors[cache_key] = (
+                data_key_decryptor(data_key) if data_key is not None
+                else record_decryptor(self.key, int(instance.salt), instance.scheme)
+            )
+        return self._decryptors[cache_key]
+
+
 class MessageEncrypted(EncryptedMixin):
-    # All fields under an EncryptedMixin must be TextFields
-    created_at = models.TextField()
-    user_from = models.TextField()
-    user_to = models.TextField()
-    content = models.TextField()
+    blind_index_fields = ('user_from', 'user_to')
+
+    # All fields under an EncryptedMixin must be TextFields (EncryptedTextFields for lazy decryption)
+    created_at = EncryptedTextField()
+    user_from = EncryptedTextField()
+    user_to = EncryptedTextField()
+    content = EncryptedTextField()
+
+    user_from_bidx = BlindIndexField()
+    user_to_bidx = BlindIndexField()
+
+    # The body's own random key, wrapped under the record's key material (see stream_key), so
+    # changing the passphrase only rewraps it. '' when there is no body - or for bodies written
+    # before body keys, which are encrypted under the record's key material directly.
+    body_key = models.TextField(blank=True, default='')
+
+    plaintext_fields = EncryptedMixin.plaintext_fields + ('body_key',)
+
+    def body_stream_key(self, key_material: bytes) -> bytes:
+        '''The key the body's chunks are encrypted under, from the record's key material'''
+        return unwrap_key(key_material, self.body_key) if self.body_key else key_material
+
+    def write_body(self, pieces, key_material: bytes, batch_size: int = 16):
+        '''Encrypt a large body from an iterable of bytes (e.g. iter_file) into EncryptedChunks,
+        replacing any previous body. Chunks are inserted `batch_size` at a time, so memory stays
+        bounded however large the body is.
+
+        Raises ValueError if the record was rekeyed since `key_material` was worked out from it.
+        '''
+        body_key = generate_data_key()
+        with transaction.atomic():
+            # locked, so rekey_messages cannot re-encrypt the record under the body key written here
+            current = MessageEncrypted.objects.select_for_update().filter(pk=self.pk).values_list(
+                'salt', 'envelope_id',
+            ).first()
+            if current != (str(self.salt), self.envelope_id):
+                raise ValueError(
+                    'The message was re-encrypted since it was opened - send the body again'
+                )
+            self.body_chunks.all().delete()
+            self.body_key = wrap_key(key_material, body_key, self.scheme)
+            self.save(update_fields=['body_key'])
+            batch = []
+            for index, frame in enumerate(encrypt_stream(body_key, pieces)):
+                batch.append(EncryptedChunk(message=self, index=index, data=frame))
+                if len(batch) == batch_size:
+                    EncryptedChunk.objects.bulk_create(batch)
+                    batch = []
+            EncryptedChunk.objects.bulk_create(batch)
+
+    def read_body(self, key_material: bytes, batch_size: int = 16):
+        '''The decrypted body, as an iterator of bytes - fetched and decrypted a chunk at a time'''
+        frames = self.body_chunks.order_by('index').values_list('data', flat=True)
+        return decrypt_stream(
+            self.body_stream_key(key_material),
+            (bytes(frame) for frame in frames.iterator(chunk_size=batch_size)),
+        )
+
+
+class EncryptedChunk(models.Model):
+    '''One frame of a message's streamed body: index 0 is the stream header, the rest are
+    authenticated chunks of ciphertext'''
+    message = models.ForeignKey(
+        MessageEncrypted, on_delete=models.CASCADE, related_name='body_chunks',
+    )
+    index = models.PositiveIntegerField()
+    data = models.BinaryField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['message', 'index'], name='unique_chunk_index'),
+        ]
+
+
+class Sequence(models.Model):
+    '''Named, monotonically increasing counters for plaintext ordering columns'''
+    name = models.CharField(max_length=50, primary_key=True)
+    value = models.BigIntegerField(default=0)
+
+    @classmethod
+    def allocate(cls, name: str, count: int = 1) -> int:
+        '''Reserve `count` consecutive values and return the first one'''
+        with transaction.atomic():
+            cls.objects.get_or_create(name=name)
+            # the UPDATE locks the row until commit, so concurrent writers get disjoint ranges
+            cls.objects.filter(name=name).update(value=F('value') + count)
+            value = cls.objects.filter(name=name).values_list('value', flat=True).get()
+        return value - count + 1
+
+
+class Conversation(models.Model):
+    '''The messages between a pair of users, so they can be paged through without decrypting others
+
+    Conversations are found by `pair_key`, a digest of the two participants' ids. By default it is
+    keyed with the sender's lookup key (like a blind index), so the database cannot tell who is
+    talking to whom - and each passphrase gets its own conversation. With
+    ENCRYPTION_CONVERSATION_PARTICIPANTS the participants are linked in plaintext instead, trading
+    that metadata for conversations that span passphrases and can be listed per user.
+    '''
+    id = models.UUIDField(primary_key=True, default=uuid4)
+    pair_key = models.CharField(max_length=32, unique=True)
+    participants = models.ManyToManyField(AppUser, related_name='conversations', blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @staticmethod
+    def pair_key_for(user_ids, lookup_key: bytes = None) -> str:
+        pair = ','.join(sorted(str(user_id) for user_id in user_ids))
+        if lookup_key is None:
+            return hashlib.sha256(f'conversation:{pair}'.encode()).hexdigest()[:32]
+        return blind_index(lookup_key, 'conversation', pair)
+
+    @classmethod
+    def open_for(cls, user_from, user_to, lookup_key: bytes = None) -> 'Conversation':
+        '''The conversation for this pair (and key, unless participants are linked), created on first use
+
+        `lookup_key` is None for unencrypted messages, whose participants are readable anyway.
+        '''
+        linked = settings.ENCRYPTION_CONVERSATION_PARTICIPANTS
+        pair_key = cls.pair_key_for((user_from, user_to), None if linked else lookup_key)
+        conversation, created = cls.objects.get_or_create(pair_key=pair_key)
+        if created and linked:
+            conversation.participants.set({str(user_from), str(user_to)})
+        return conversation
+
+    @property
+    def sequence_name(self) -> str:
+        return f'conversation:{self.id}'
 
 
 class Message(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid4)
     encrypted = models.OneToOneField(MessageEncrypted, on_delete=models.CASCADE)
+    # Insertion order, in plaintext - created_at is encrypted so cannot be ordered on by the DB
+    sequence = models.BigIntegerField(unique=True, editable=False)
+    # Null for messages sent before conversations existed
+    conversation = models.ForeignKey(
+        Conversation, null=True, blank=True, on_delete=models.PROTECT, related_name='messages',
+    )
+    conversation_sequence = models.BigIntegerField(null=True, editable=False)
+
+    class Meta:
+        constraints = [
+            # also the index a conversation's pages are read from
+            models.UniqueConstraint(
+                fields=['conversation', 'conversation_sequence'], name='unique_conversation_sequence',
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.sequence is None:
+            self.sequence = Sequence.allocate('message')
+        if self.conversation_id is not None and self.conversation_sequence is None:
+            self.conversation_sequence = Sequence.allocate(self.conversation.sequence_name)
+        super().save(*args, **kwargs)
+
+
+class RekeyCheckpoint(models.Model):
+    '''Progress of a rekey_messages run, saved with each batch so an interrupted run can resume'''
+    name = models.CharField(max_length=50, primary_key=True)
+    old_key_tag = models.CharField(max_length=16)
+    new_key_tag = models.CharField(max_length=16)
+    # rows are processed in message sequence order, so rows sent during a run come after it
+    last_sequence = models.BigIntegerField(null=True)
+    rekeyed = models.BigIntegerField(default=0)
+    skipped = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
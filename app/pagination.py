@@ -0,0 +1,21 @@
+from rest_framework.pagination import CursorPagination
+
+
+class MessageCursorPagination(CursorPagination):
+    # keyset pagination on the plaintext sequence -> each page is one indexed range query
+    ordering = '-sequence'
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+
+
+class ConversationCursorPagination(MessageCursorPagination):
+    # a range of the (conversation, conversation_sequence) unique index
+    ordering = '-conversation_sequence'
+
+
+class AppUserCursorPagination(CursorPagination):
+    ordering = 'created_at'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
@@ -3,7 +3,16 @@ import base64
 from rest_framework import serializers
 
 from .encryption import decrypt_data
-from .models import AppUser, Message, MessageEncrypted
+from .models import AppUser, Conversation, Message, MessageEncrypted
+from .users import existing_user_ids
+
+
+def unknown_user_errors(attrs: dict, existing: set) -> dict:
+    '''Errors for user_from/user_to ids in `attrs` that are not in `existing`'''
+    return {
+        field: [f'Invalid pk "{attrs[field]}" - object does not exist.']
+        for field in ('user_from', 'user_to') if attrs[field] not in existing
+    }
 
 
 class AppUserSerializer(serializers.ModelSerializer):
@@ -18,17 +27,54 @@ class MessageSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+class ConversationSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Conversation
+        fields = ['id', 'participants', 'created_at']
+
+
 class SendMessageSerializer(serializers.Serializer):
-    user_from = serializers.PrimaryKeyRelatedField(queryset=AppUser.objects.all())
-    user_to = serializers.PrimaryKeyRelatedField(queryset=AppUser.objects.all())
+    # checked against the user id cache in validate(), rather than a query per field
+    user_from = serializers.UUIDField()
+    user_to = serializers.UUIDField()
     content = serializers.CharField()
 
     # This field is not stored. Combine the content with the key to encrypt
     # User's responsibility to remember their encryption key.
     key = serializers.CharField(required=False)
 
+    def validate(self, attrs):
+        existing = existing_user_ids([attrs['user_from'], attrs['user_to']])
+        if errors := unknown_user_errors(attrs, existing):
+            raise serializers.ValidationError(errors)
+        return attrs
+
+
+class BulkMessageSerializer(serializers.Serializer):
+    # validated item by item, so one bad message does not reject the whole batch. Users are checked
+    # for the whole batch at once, with unknown_user_errors
+    user_from = serializers.UUIDField()
+    user_to = serializers.UUIDField()
+    content = serializers.CharField()
+
+
+class SendMessagesBulkSerializer(serializers.Serializer):
+    # any JSON per item - each is validated on its own, so one bad item does not reject the batch
+    messages = serializers.ListField(
+        child=serializers.JSONField(allow_null=True), allow_empty=False, max_length=1000
+    )
+    key = serializers.CharField(required=False)
+
 
 class DecryptedMessageSerializer(serializers.Serializer):
+    def __init__(self, *args, **kwargs):
+        # only the listed fields are read from the record - the rest are never decrypted
+        only = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+        if only is not None:
+            for name in set(self.fields) - set(only):
+                self.fields.pop(name)
+
     created_at = serializers.DateTimeField()
     user_from = serializers.UUIDField()
     user_to = serializers.UUIDField()
@@ -39,7 +85,9 @@ class EncryptedMessageSerializer(serializers.ModelSerializer):
     # in case user requests non-decrypted data back, provide as all strings (as per model)
     class Meta:
         model = MessageEncrypted
-        exclude = ['id', 'salt']
+        exclude = [
+            'id', 'salt', 'envelope', 'key_tag', 'scheme', 'user_from_bidx', 'user_to_bidx', 'body_key',
+        ]
 
 
 class ListMessageSerializer(serializers.Serializer):
@@ -50,3 +98,10 @@ class ListMessageSerializer(serializers.Serializer):
 
     id = serializers.UUIDField()
     encrypted = EncryptedMessageSerializer()  # default but may be overridden
+
+    def get_fields(self):
+        # declared fields are copied from the class, so put the override in place of the default
+        fields = super().get_fields()
+        if hasattr(self, 'encrypted'):
+            fields['encrypted'] = self.encrypted
+        return fields
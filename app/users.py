@@ -0,0 +1,107 @@
+'''Which AppUser ids exist, cached in-process so sends can check their users without a query each
+
+Only ids known to exist are cached. An AppUser save or delete drops its id straight away, but
+other processes only notice a delete once their entry expires, so keep `ttl` short.
+'''
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable
+from uuid import UUID
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import AppUser
+
+
+class UserIdCache:
+    '''Bounded LRU set of existing user ids, with expiry'''
+
+    def __init__(self, max_size: int = 10000, ttl: float = 60.0):
+        if max_size < 1:
+            raise ValueError('max_size must be at least 1')
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[UUID, float] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def known(self, ids: set[UUID]) -> set[UUID]:
+        '''The ids among `ids` cached as existing'''
+        now = time.monotonic()
+        found = set()
+        with self._lock:
+            for user_id in ids:
+                expires_at = self._entries.get(user_id)
+                if expires_at is not None and expires_at > now:
+                    self._entries.move_to_end(user_id)
+                    found.add(user_id)
+                elif expires_at is not None:
+                    del self._entries[user_id]
+            self.hits += len(found)
+            self.misses += len(ids) - len(found)
+        return found
+
+    def add(self, ids: Iterable[UUID]):
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            for user_id in ids:
+                self._entries[user_id] = expires_at
+                self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, user_id: UUID):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def purge(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self), 'max_size': self.max_size}
+
+
+# Disabled unless configured (see APP_USER_CACHE in settings)
+_user_cache: UserIdCache | None = None
+
+
+def configure_user_cache(max_size: int = 10000, ttl: float = 60.0) -> UserIdCache:
+    global _user_cache
+    _user_cache = UserIdCache(max_size=max_size, ttl=ttl)
+    return _user_cache
+
+
+def disable_user_cache():
+    global _user_cache
+    _user_cache = None
+
+
+def get_user_cache() -> UserIdCache | None:
+    return _user_cache
+
+
+def existing_user_ids(ids: Iterable[UUID | str]) -> set[UUID]:
+    '''The ids among `ids` that belong to an AppUser - one `id__in` query for any not cached'''
+    ids = {UUID(str(user_id)) for user_id in ids}
+    cache = _user_cache
+    found = cache.known(ids) if cache is not None else set()
+    if missing := ids - found:
+        fetched = set(AppUser.objects.filter(id__in=missing).values_list('id', flat=True))
+        if cache is not None:
+            cache.add(fetched)
+        found |= fetched
+    return found
+
+
+@receiver(post_save, sender=AppUser)
+@receiver(post_delete, sender=AppUser)
+def _forget_user(sender, instance: AppUser, **kwargs):
+    if _user_cache is not None:
+        _user_cache.discard(instance.id)
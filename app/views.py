@@ -1,20 +1,55 @@
+import asyncio
+import hashlib
+import json
+import os
 import random
+import time
 from datetime import datetime
+from functools import partial
+from itertools import islice
 from operator import attrgetter
+from uuid import UUID
 
+from asgiref.sync import sync_to_async
+from cryptography.fernet import InvalidToken
+from django.conf import settings
 from django.db import transaction
+from django.db.models import Count, Max
+from django.shortcuts import get_object_or_404
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 from rest_framework import generics
 from rest_framework.exceptions import ValidationError
 from rest_framework.views import APIView
 from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
 
-from .models import AppUser, Message, MessageEncrypted
+from . import metrics
+from .encryption import (
+    derive_lookup_key, encrypt_record, generate_data_key, iter_file, key_check_tag, unwrap_data_key,
+    wrap_data_key,
+)
+from .executors import adecrypt_all, get_decryption_executor, run_crypto
+from .models import (
+    AppUser, Conversation, KeyEnvelope, Keyring, Message, MessageEncrypted, Sequence,
+)
+from .models import get_lookup_key, get_write_scheme
+from .pagination import (
+    AppUserCursorPagination, ConversationCursorPagination, MessageCursorPagination,
+)
 from .serializers import AppUserSerializer, SendMessageSerializer, ListMessageSerializer, EncryptedMessageSerializer, DecryptedMessageSerializer
+from .serializers import BulkMessageSerializer, ConversationSerializer, SendMessagesBulkSerializer
+from .serializers import unknown_user_errors
+from .users import existing_user_ids
 
 
 class AppUserListView(generics.ListCreateAPIView):
     queryset = AppUser.objects.all()
     serializer_class = AppUserSerializer
+    pagination_class = AppUserCursorPagination
 
 
 class CreateMessageView(generics.CreateAPIView):
@@ -22,47 +57,600 @@ class CreateMessageView(generics.CreateAPIView):
     serializer_class = SendMessageSerializer
 
     def post(self, request):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        user_from = str(serializer.validated_data['user_from'])
+        user_to = str(serializer.validated_data['user_to'])
+
         message_enc = MessageEncrypted(
-            user_from=request.data['user_from'],
-            user_to=request.data['user_to'],
-            content=request.data['content'],
+            user_from=user_from,
+            user_to=user_to,
+            content=serializer.validated_data['content'],
             salt=random.randint(0, 1000),
             created_at=datetime.now().isoformat(),
         )
-        if key := request.data.get('key'):
-            message_enc.encrypt(key)  # modifies state in-place
+        key = serializer.validated_data.get('key')
+        lookup_key = get_lookup_key(key) if key else None
+        if key and not settings.ENCRYPTION_ENVELOPE_MODE:
+            message_enc.encrypt(key, lookup_key)  # modifies state in-place
 
         message = Message(encrypted=message_enc)
 
         with transaction.atomic():
+            if key and settings.ENCRYPTION_ENVELOPE_MODE:
+                envelope, data_key = KeyEnvelope.open_for(user_from, key, lookup_key)
+                message_enc.encrypt_with_envelope(envelope, data_key, lookup_key)
+            message.conversation = Conversation.open_for(user_from, user_to, lookup_key)
             message_enc.save()
             message.save()
 
         return Response({'message': 'Message created'}, 201)
 
 
+class CreateMessagesBulkView(APIView):
+    '''Send many messages under one key in a single request
+
+    Keys are derived once per batch (or once per sender's envelope), and all rows are written with
+    bulk_create in one transaction. Invalid messages are reported by index and skipped.
+    '''
+
+    def post(self, request):
+        serializer = SendMessagesBulkSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        key = serializer.validated_data.get('key')
+
+        items, errors = [], []
+        for index, item in enumerate(serializer.validated_data['messages']):
+            item_serializer = BulkMessageSerializer(data=item)
+            if item_serializer.is_valid():
+                items.append((index, item_serializer.validated_data))
+            else:
+                errors.append({'index': index, 'errors': item_serializer.errors})
+
+        # every sender and recipient in the batch, checked at once
+        existing = existing_user_ids(
+            user_id for _, item in items for user_id in (item['user_from'], item['user_to'])
+        )
+        messages_enc = []
+        for index, item in items:
+            if user_errors := unknown_user_errors(item, existing):
+                errors.append({'index': index, 'errors': user_errors})
+                continue
+
+            messages_enc.append(MessageEncrypted(
+                user_from=str(item['user_from']),
+                user_to=str(item['user_to']),
+                content=item['content'],
+                salt=random.randint(0, 1000),
+                created_at=datetime.now().isoformat(),
+            ))
+
+        if not messages_enc:
+            return Response({'created': 0, 'errors': errors}, 400)
+
+        # read before they are encrypted
+        pairs = [(message_enc.user_from, message_enc.user_to) for message_enc in messages_enc]
+        lookup_key = get_lookup_key(key) if key else None
+        if key and not settings.ENCRYPTION_ENVELOPE_MODE:
+            MessageEncrypted.encrypt_many(messages_enc, key, lookup_key)  # modifies state in-place
+
+        with transaction.atomic():
+            if key and settings.ENCRYPTION_ENVELOPE_MODE:
+                envelopes = {}  # one envelope (and one key derivation) per sender
+                for message_enc, (owner_id, _) in zip(messages_enc, pairs):
+                    if owner_id not in envelopes:
+                        envelopes[owner_id] = KeyEnvelope.open_for(owner_id, key, lookup_key)
+                    message_enc.encrypt_with_envelope(*envelopes[owner_id], lookup_key)
+
+            first_sequence = Sequence.allocate('message', len(messages_enc))
+            messages = [
+                Message(encrypted=message_enc, sequence=first_sequence + i)
+                for i, message_enc in enumerate(messages_enc)
+            ]
+            _assign_conversations(messages, pairs, lookup_key)
+            MessageEncrypted.objects.bulk_create(messages_enc)
+            Message.objects.bulk_create(messages)
+
+        return Response({'created': len(messages_enc), 'errors': errors}, 201)
+
+
+def _assign_conversations(messages: list[Message], pairs: list[tuple], lookup_key: bytes | None):
+    '''Put each message in its pair's conversation, allocating each conversation's sequence
+    numbers in one go'''
+    by_pair = {}
+    for message, pair in zip(messages, pairs):
+        by_pair.setdefault(tuple(sorted(pair)), []).append(message)
+    for pair, conversation_messages in by_pair.items():
+        conversation = Conversation.open_for(*pair, lookup_key)
+        first = Sequence.allocate(conversation.sequence_name, len(conversation_messages))
+        for i, message in enumerate(conversation_messages):
+            message.conversation = conversation
+            message.conversation_sequence = first + i
+
+
+def _filter_by_users(queryset, params, keyring: Keyring | None):
+    '''?user_from=<uuid>&user_to=<uuid> - an indexed lookup, so only matching rows are decrypted
+
+    Encrypted rows are matched on their blind indexes, which only rows written with the same key
+    can match. Unencrypted rows hold the plaintext, so are matched on that directly.
+    '''
+    filters = {}
+    for field in MessageEncrypted.blind_index_fields:
+        if value := params.get(field):
+            try:
+                filters[field] = str(UUID(value))
+            except ValueError:
+                raise ValidationError({field: 'Must be a valid UUID.'})
+
+    if filters and keyring is not None:
+        filters = MessageEncrypted.blind_index_lookups(keyring.lookup_key, **filters)
+    return queryset.filter(**{f'encrypted__{name}': value for name, value in filters.items()})
+
+
+def _decrypt_messages(
+    messages: list[Message], keyring: Keyring | None, fields: list[str] = None
+) -> list[Message]:
+    '''Rows that cannot be decrypted (untagged rows under another key, or tag collisions) are left
+    out rather than failing the whole list. With `fields`, the others are only decrypted if read.'''
+    if keyring is None:
+        return messages
+
+    by_encrypted_id = {message.encrypted_id: message for message in messages}
+    decrypted = get_decryption_executor().decrypt_all(
+        [message.encrypted for message in messages], keyring, skip_failures=True, fields=fields,
+    )
+    metrics.increment('messages.decrypted', len(decrypted))
+    metrics.increment('messages.undecryptable', len(messages) - len(decrypted))
+    return [by_encrypted_id[message_enc.id] for message_enc in decrypted]
+
+
+def _list_fields(params) -> list[str] | None:
+    '''?fields=created_at,user_to - which decrypted fields a keyed listing returns (default all),
+    so one that does not show content never decrypts it'''
+    if (value := params.get('fields')) is None:
+        return None
+    fields = [name for name in value.split(',') if name]
+    if unknown := set(fields) - set(DecryptedMessageSerializer().fields):
+        raise ValidationError({'fields': f'Unknown fields: {", ".join(sorted(unknown))}.'})
+    return fields
+
+
+def _message_queryset(params, keyring: Keyring | None):
+    # created_at is encrypted, so order on the plaintext insertion sequence instead
+    queryset = Message.objects.all().select_related(
+        'encrypted', 'encrypted__envelope'
+    ).order_by('-sequence')
+    if keyring is not None:
+        # skip rows written with other keys in SQL, rather than failing to decrypt them
+        queryset = queryset.filter(
+            MessageEncrypted.key_tag_filter(keyring.lookup_key, prefix='encrypted__')
+        )
+    return _filter_by_users(queryset, params, keyring)
+
+
+def _list_etag(latest: dict, params, keyring: Keyring | None) -> str:
+    '''Validator for a message listing, built from plaintext metadata only
+
+    `latest` is the listing's newest sequence and row count - one aggregate query, so a client
+    polling for changes gets its 304 without a row being fetched or decrypted. The key goes in only
+    as its key check tag, never the passphrase itself.
+    '''
+    fingerprint = key_check_tag(keyring.lookup_key) if keyring is not None else ''
+    query = sorted((name, values) for name, values in params.lists() if name != 'key')
+    validator = json.dumps([latest['sequence'], latest['count'], fingerprint, query])
+    return '"%s"' % hashlib.sha256(validator.encode()).hexdigest()[:32]
+
+
+def _not_modified(request, etag: str):
+    '''The 304 for a matching If-None-Match, or None when the listing has to be sent'''
+    response = get_conditional_response(request, etag=etag)
+    if response is not None:
+        _set_validator(response, etag)
+    return response
+
+
+def _set_validator(response, etag: str):
+    response['ETag'] = etag
+    # decrypted content: never cached by shared caches, always revalidated by the client
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
 class ListMessageView(APIView):
+    stream_chunk_size = 500
     
     def get(self, request, *args, **kwargs):
         key = request.query_params.get('key')
-        queryset = Message.objects.all().select_related('encrypted')
+        keyring = Keyring(key) if key else None  # envelopes are unwrapped once, not per message
+        queryset = _message_queryset(request.query_params, keyring)
+        encrypted_serializer = DecryptedMessageSerializer if key else EncryptedMessageSerializer
+        if (fields := _list_fields(request.query_params)) and key:
+            encrypted_serializer = partial(DecryptedMessageSerializer, fields=fields)
+
+        with metrics.phase('view.validate'):
+            latest = queryset.order_by().aggregate(sequence=Max('sequence'), count=Count('id'))
+            etag = _list_etag(latest, request.query_params, keyring)
+        if (not_modified := _not_modified(request, etag)) is not None:
+            return not_modified
+        response = self._list(request, queryset, keyring, encrypted_serializer, fields)
+        return _set_validator(response, etag)
+
+    def _list(self, request, queryset, keyring: Keyring | None, encrypted_serializer, fields):
+        # only paginate when asked to, so the plain list response stays as it was
+        paginate = 'cursor' in request.query_params or 'page_size' in request.query_params
+        if not paginate and request.query_params.get('stream') in ('1', 'true'):
+            return self._stream(queryset, keyring, encrypted_serializer, fields)
+
+        paginator = None
+        with metrics.phase('view.fetch'):
+            if paginate:
+                paginator = MessageCursorPagination()
+                messages = paginator.paginate_queryset(queryset, request, view=self)
+            else:
+                messages = list(queryset)
+
+        with metrics.phase('view.decrypt'):
+            messages = _decrypt_messages(messages, keyring, fields)
+
+        with metrics.phase('view.serialize'):
+            data = ListMessageSerializer(
+                messages, many=True, encrypted_serializer=encrypted_serializer()
+            ).data
+
+        if paginator is not None:
+            return paginator.get_paginated_response(data)
+        return Response(data, status=200)
+
+    def _stream(self, queryset, keyring: Keyring | None, encrypted_serializer, fields):
+        '''Fetch, decrypt and write out one chunk at a time, so memory does not grow with the table'''
+        rows = queryset.iterator(chunk_size=self.stream_chunk_size)
+
+        def render():
+            yield '['
+            separator = ''
+            while chunk := list(islice(rows, self.stream_chunk_size)):
+                serializer = ListMessageSerializer(
+                    _decrypt_messages(chunk, keyring, fields), many=True,
+                    encrypted_serializer=encrypted_serializer(),
+                )
+                for item in serializer.data:
+                    yield separator + json.dumps(item, cls=JSONEncoder)
+                    separator = ','
+            yield ']'
+
+        return StreamingHttpResponse(render(), content_type='application/json', status=200)
+
+
+def _sync_params(params, max_wait: float) -> tuple[int, float]:
+    '''?since=<cursor>&wait=<seconds> - the last sequence the client has, and how long to hold'''
+    try:
+        since, wait = int(params.get('since', 0)), float(params.get('wait', 0))
+    except ValueError:
+        raise ValidationError({'detail': 'since must be an integer and wait a number of seconds.'})
+    if since < 0 or not 0 <= wait:
+        raise ValidationError({'detail': 'since and wait cannot be negative.'})
+    return since, min(wait, max_wait)
+
+
+def _sync_response(data: list, rows: list[Message], since: int, batch_size: int) -> dict:
+    '''`rows` as fetched, `data` the serialized ones of them that could be decrypted
+
+    The cursor moves past every fetched row, so one that cannot be decrypted is not fetched again.
+    '''
+    return {
+        'cursor': rows[-1].sequence if rows else since,
+        'has_more': len(rows) == batch_size,
+        'results': data,
+    }
+
+
+class MessageSyncView(APIView):
+    '''Messages added since the client's cursor, oldest first: /api/messages/sync/?since=<cursor>
+
+    The cursor is the plaintext `Message.sequence` of the last message returned, so each call is a
+    range scan of the sequence index and decrypts only the new rows. With ?wait=<seconds> the request
+    is held, polling with a cheap EXISTS query, until something new arrives or the wait runs out.
+    Takes the same key and user_from/user_to parameters as /api/view-messages/.
+
+    Sequences are allocated under a row lock held until the message is committed, so they become
+    visible in order and a cursor never skips a row that commits late.
+    '''
+    batch_size = 500
+    max_wait = 30
+    poll_interval = 0.5
+
+    def get(self, request, *args, **kwargs):
+        since, wait = _sync_params(request.query_params, self.max_wait)
+        key = request.query_params.get('key')
+        keyring = Keyring(key) if key else None
+        queryset = _message_queryset(request.query_params, keyring).filter(sequence__gt=since)
+
+        deadline = time.monotonic() + wait
+        while time.monotonic() < deadline and not queryset.exists():
+            time.sleep(self.poll_interval)
 
-        if not key:
-            encrypted_serializer = EncryptedMessageSerializer
+        rows = list(queryset.order_by('sequence')[:self.batch_size])
+        encrypted_serializer = DecryptedMessageSerializer if key else EncryptedMessageSerializer
+        data = ListMessageSerializer(
+            _decrypt_messages(rows, keyring), many=True, encrypted_serializer=encrypted_serializer(),
+        ).data
+        return Response(_sync_response(data, rows, since, self.batch_size), status=200)
+
+
+class ConversationListView(APIView):
+    '''Find conversations: ?participants=<uuid>,<uuid>[&key=<key>], or ?participant=<uuid>
+
+    Conversations of encrypted messages are only found with the key they were sent with, unless
+    participants are linked in plaintext (ENCRYPTION_CONVERSATION_PARTICIPANTS) - which is also
+    what listing by a single participant needs.
+    '''
+
+    def get(self, request):
+        if participants := request.query_params.get('participants'):
+            user_ids = participants.split(',')
+            if len(user_ids) != 2:
+                raise ValidationError({'participants': 'Must be two comma-separated user ids.'})
+            pair_keys = [Conversation.pair_key_for(user_ids)]
+            if key := request.query_params.get('key'):
+                pair_keys.append(Conversation.pair_key_for(user_ids, get_lookup_key(key)))
+            conversations = Conversation.objects.filter(pair_key__in=pair_keys)
+        elif participant := request.query_params.get('participant'):
+            try:
+                conversations = Conversation.objects.filter(participants=UUID(participant))
+            except ValueError:
+                raise ValidationError({'participant': 'Must be a valid UUID.'})
         else:
-            for message in queryset:
-                try:
-                    message.encrypted.decrypt(key)
-                except:
-                    raise ValidationError('Could not be decrypted with that key.')
+            raise ValidationError('Pass participants or participant.')
 
-            encrypted_serializer = DecryptedMessageSerializer
+        conversations = conversations.prefetch_related('participants').order_by('-created_at')
+        return Response(ConversationSerializer(conversations, many=True).data, status=200)
+
+
+class ConversationMessagesView(APIView):
+    '''One page of a conversation, newest first - only that page is fetched and decrypted'''
+
+    def get(self, request, pk):
+        conversation = get_object_or_404(Conversation, pk=pk)
+        key = request.query_params.get('key')
+        keyring = Keyring(key) if key else None
 
-        # if still encrypted, this is nonsensical -> which is what we want
-        # Do not use queryset.order_by -> it re-encrypts data (must not be an in-place operation)
-        queryset = sorted(queryset, key=lambda x: x.encrypted.created_at, reverse=True)
+        queryset = conversation.messages.select_related('encrypted', 'encrypted__envelope')
+        if keyring is not None:
+            queryset = queryset.filter(
+                MessageEncrypted.key_tag_filter(keyring.lookup_key, prefix='encrypted__')
+            )
+        paginator = ConversationCursorPagination()
+        page = paginator.paginate_queryset(queryset, request, view=self)
 
+        encrypted_serializer = DecryptedMessageSerializer if key else EncryptedMessageSerializer
         serializer = ListMessageSerializer(
-            queryset, many=True, encrypted_serializer=encrypted_serializer()
+            _decrypt_messages(page, keyring), many=True, encrypted_serializer=encrypted_serializer(),
+        )
+        return paginator.get_paginated_response(serializer.data)
+
+
+@method_decorator(csrf_exempt, name='dispatch')  # as DRF's APIViews are
+class MessageBodyView(View):
+    '''PUT or GET a message's large body, as raw bytes: /api/messages/<id>/body/?key=<key>
+
+    Bodies are encrypted and decrypted a chunk at a time as they stream in and out (see
+    app.encryption.encrypt_stream), so they are never held in memory whole. The key must be the one
+    the message was sent with.
+    '''
+
+    def _open(self, request, pk) -> tuple[MessageEncrypted, bytes]:
+        message = Message.objects.select_related('encrypted', 'encrypted__envelope').filter(
+            pk=pk
+        ).first()
+        if message is None:
+            raise Http404
+        if not (key := request.GET.get('key')):
+            raise ValidationError({'key': 'This field is required.'})
+        if message.encrypted.key_tag == '':
+            raise ValidationError({'key': 'This message is not encrypted.'})
+        try:
+            return message.encrypted, message.encrypted.stream_key(key)
+        except InvalidToken:
+            raise ValidationError({'key': 'Does not decrypt this message.'})
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        except ValidationError as error:
+            return JsonResponse(error.detail, status=400)
+
+    def put(self, request, pk):
+        message_enc, key_material = self._open(request, pk)
+        try:
+            message_enc.write_body(iter_file(request), key_material)
+        except ValueError as error:  # rekeyed while the body was on its way
+            return JsonResponse({'detail': str(error)}, status=409)
+        return JsonResponse({'message': 'Body stored'}, status=201)
+
+    def get(self, request, pk):
+        message_enc, key_material = self._open(request, pk)
+        if not message_enc.body_chunks.exists():
+            raise Http404
+        return StreamingHttpResponse(
+            message_enc.read_body(key_material), content_type='application/octet-stream',
+        )
+
+
+# Async endpoints, for ASGI deployments. Nothing CPU-bound runs on the event loop: key derivation
+# and encryption go to the crypto executor (see run_crypto), so slow keys cannot stall other requests.
+
+def _encrypt_job(
+    key: str, salt: int, scheme: int, pepper: str, values: dict[str, str]
+) -> tuple[dict, bytes]:
+    return encrypt_record(key, salt, values, scheme), derive_lookup_key(key, pepper)
+
+
+async def _aopen_envelope(owner_id, key: str, lookup_key: bytes) -> tuple[KeyEnvelope, bytes]:
+    '''KeyEnvelope.open_for, with the unwrapping done on the crypto executor'''
+    key_tag = key_check_tag(lookup_key)
+    async for envelope in KeyEnvelope.candidates(owner_id, lookup_key):
+        try:
+            data_key = await run_crypto(
+                unwrap_data_key, key, int(envelope.salt), envelope.wrapped_key, envelope.scheme
+            )
+        except InvalidToken:
+            continue  # untagged, and wrapped under another passphrase
+        if envelope.key_tag is None:
+            envelope.key_tag = key_tag
+            await envelope.asave(update_fields=['key_tag'])
+        return envelope, data_key
+
+    data_key = generate_data_key()
+    salt = int.from_bytes(os.urandom(16), byteorder='big')
+    scheme = get_write_scheme()
+    wrapped_key = await run_crypto(wrap_data_key, key, salt, data_key, scheme)
+    envelope = await KeyEnvelope.objects.acreate(
+        owner_id=owner_id, salt=salt, scheme=scheme, key_tag=key_tag, wrapped_key=wrapped_key,
+    )
+    return envelope, data_key
+
+
+@method_decorator(csrf_exempt, name='dispatch')  # as DRF's APIViews are
+class AsyncCreateMessageView(View):
+
+    async def post(self, request):
+        if request.content_type == 'application/json':
+            try:
+                data = json.loads(request.body)
+            except ValueError as error:  # as DRF's JSONParser answers it
+                return JsonResponse({'detail': f'JSON parse error - {error}'}, status=400)
+        else:
+            data = request.POST
+        serializer = SendMessageSerializer(data=data)
+        # checking the users may need a query, but rarely does (see app.users)
+        if not await sync_to_async(serializer.is_valid)():
+            return JsonResponse(serializer.errors, status=400)
+
+        message_enc = MessageEncrypted(
+            user_from=str(serializer.validated_data['user_from']),
+            user_to=str(serializer.validated_data['user_to']),
+            content=serializer.validated_data['content'],
+            salt=random.randint(0, 1000),
+            created_at=datetime.now().isoformat(),
         )
-        return Response(serializer.data, status=200)
+        pair = (message_enc.user_from, message_enc.user_to)  # read before they are encrypted
+
+        lookup_key = None
+        if key := serializer.validated_data.get('key'):
+            pepper = settings.ENCRYPTION_LOOKUP_PEPPER
+            if settings.ENCRYPTION_ENVELOPE_MODE:
+                lookup_key = await run_crypto(derive_lookup_key, key, pepper)
+                envelope, data_key = await _aopen_envelope(message_enc.user_from, key, lookup_key)
+                message_enc.encrypt_with_envelope(envelope, data_key, lookup_key)  # AES only
+            else:
+                salt = int.from_bytes(os.urandom(16), byteorder='big')
+                scheme = get_write_scheme()
+                values, lookup_key = await run_crypto(
+                    _encrypt_job, key, salt, scheme, pepper, message_enc._encrypted_values()
+                )
+                message_enc._set_lookups(lookup_key)
+                message_enc.salt = salt
+                message_enc.scheme = scheme
+                message_enc._set_values(values)
+
+        # async transactions are not supported yet, so the inserts run together in a thread
+        await sync_to_async(self._save)(message_enc, pair, lookup_key)
+        return JsonResponse({'message': 'Message created'}, status=201)
+
+    @staticmethod
+    def _save(message_enc: MessageEncrypted, pair: tuple, lookup_key: bytes | None):
+        with transaction.atomic():
+            conversation = Conversation.open_for(*pair, lookup_key)
+            message_enc.save()
+            Message(encrypted=message_enc, conversation=conversation).save()
+
+
+async def _akeyring(key: str | None) -> Keyring | None:
+    if not key:
+        return None
+    lookup_key = await run_crypto(derive_lookup_key, key, settings.ENCRYPTION_LOOKUP_PEPPER)
+    return Keyring(key, lookup_key=lookup_key)
+
+
+async def _adecrypt_messages(messages: list[Message], keyring: Keyring | None) -> list[Message]:
+    '''_decrypt_messages, on the async executor'''
+    if keyring is None:
+        return messages
+
+    by_encrypted_id = {message.encrypted_id: message for message in messages}
+    decrypted = await adecrypt_all(
+        [message.encrypted for message in messages], keyring, skip_failures=True
+    )
+    metrics.increment('messages.decrypted', len(decrypted))
+    metrics.increment('messages.undecryptable', len(messages) - len(decrypted))
+    return [by_encrypted_id[message_enc.id] for message_enc in decrypted]
+
+
+class AsyncListMessageView(View):
+
+    async def get(self, request):
+        keyring = await _akeyring(request.GET.get('key'))
+        try:
+            queryset = _message_queryset(request.GET, keyring)
+        except ValidationError as error:
+            return JsonResponse(error.detail, status=400)
+
+        with metrics.phase('view.validate'):
+            latest = await queryset.order_by().aaggregate(
+                sequence=Max('sequence'), count=Count('id')
+            )
+            etag = _list_etag(latest, request.GET, keyring)
+        if (not_modified := _not_modified(request, etag)) is not None:
+            return not_modified
+
+        with metrics.phase('view.fetch'):
+            messages = [message async for message in queryset]
+
+        with metrics.phase('view.decrypt'):
+            messages = await _adecrypt_messages(messages, keyring)
+        encrypted_serializer = DecryptedMessageSerializer if keyring else EncryptedMessageSerializer
+
+        with metrics.phase('view.serialize'):
+            data = ListMessageSerializer(
+                messages, many=True, encrypted_serializer=encrypted_serializer()
+            ).data
+        return _set_validator(
+            JsonResponse(data, status=200, safe=False, encoder=JSONEncoder), etag
+        )
+
+
+class AsyncMessageSyncView(View):
+    '''MessageSyncView, holding long polls on the event loop rather than a worker thread'''
+
+    async def get(self, request):
+        try:
+            since, wait = _sync_params(request.GET, MessageSyncView.max_wait)
+            keyring = await _akeyring(request.GET.get('key'))
+            queryset = _message_queryset(request.GET, keyring).filter(sequence__gt=since)
+        except ValidationError as error:
+            return JsonResponse(error.detail, status=400)
+
+        deadline = time.monotonic() + wait
+        while time.monotonic() < deadline and not await queryset.aexists():
+            await asyncio.sleep(MessageSyncView.poll_interval)
+
+        batch_size = MessageSyncView.batch_size
+        rows = [message async for message in queryset.order_by('sequence')[:batch_size]]
+        encrypted_serializer = DecryptedMessageSerializer if keyring else EncryptedMessageSerializer
+        data = ListMessageSerializer(
+            await _adecrypt_messages(rows, keyring), many=True,
+            encrypted_serializer=encrypted_serializer(),
+        ).data
+        return JsonResponse(
+            _sync_response(data, rows, since, batch_size), status=200, encoder=JSONEncoder
+        )
+
+
+class MetricsView(View):
+    '''Prometheus scrape endpoint - only exists when ENCRYPTION_METRICS uses the prometheus sink'''
+
+    def get(self, request):
+        sink = metrics.get_metrics_sink()
+        if not isinstance(sink, metrics.PrometheusSink):
+            raise Http404
+        return HttpResponse(sink.render(), content_type='text/plain; version=0.0.4')
@@ -0,0 +1,33 @@
+'''Offline micro-benchmarks for the encryption and message paths
+
+Each module is runnable on its own, e.g. `python -m benchmarks.record_crypto`. Nothing here is
+imported by the app.
+'''
+import os
+import time
+
+
+def setup_django():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'encrypted_db.settings')
+
+    import django
+    django.setup()
+
+
+def setup_test_database():
+    '''Point Django at a throwaway test database, so benchmarks never touch db.sqlite3'''
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0)
+
+
+def best_of(func, repeat: int = 5) -> float:
+    '''Best wall-clock time (seconds) of `repeat` calls - least affected by noise'''
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
@@ -0,0 +1,51 @@
+'''Messages/sec through the single-message endpoint vs the bulk endpoint
+
+    python -m benchmarks.bulk_ingest [--count 200] [--batch-size 100]
+'''
+import argparse
+import time
+
+from benchmarks import setup_django, setup_test_database
+
+setup_django()
+setup_test_database()
+
+from django.test import Client  # noqa: E402
+
+from app.models import AppUser  # noqa: E402
+
+KEY = 'SuperSecretKey123'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=100)
+    args = parser.parse_args()
+
+    client = Client()
+    user_from = str(AppUser.objects.create(name='Alfie').id)
+    user_to = str(AppUser.objects.create(name='Brenda').id)
+    message = {'user_from': user_from, 'user_to': user_to, 'key': KEY, 'content': 'lorem ipsum ' * 10}
+
+    start = time.perf_counter()
+    for _ in range(args.count):
+        client.post('/api/send-message/', data=message)
+    single = args.count / (time.perf_counter() - start)
+
+    batch = [{k: v for k, v in message.items() if k != 'key'}] * args.batch_size
+    start = time.perf_counter()
+    for _ in range(args.count // args.batch_size):
+        client.post(
+            '/api/send-messages/bulk/', data={'key': KEY, 'messages': batch},
+            content_type='application/json',
+        )
+    bulk = (args.count // args.batch_size * args.batch_size) / (time.perf_counter() - start)
+
+    print(f'{"endpoint":<24}{"messages/s":>12}')
+    print(f'{"send-message":<24}{single:>12,.1f}')
+    print(f'{"send-messages/bulk":<24}{bulk:>12,.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+'''Cost of each registered KDF, and throughput of each cipher by payload size
+
+    python -m benchmarks.ciphers
+'''
+import os
+
+from benchmarks import best_of, setup_django
+
+setup_django()
+
+from app import encryption  # noqa: E402
+
+SIZES_KB = (1, 16, 256)
+
+
+def main():
+    key, salt = 'SuperSecretKey123', 1234567890
+
+    print(f'{"kdf":<24}{"ms/derive":>10}')
+    for name, kdf in encryption.KDFS.items():
+        print(f'{name:<24}{best_of(lambda: kdf.derive(key, salt)) * 1000:>10.2f}')
+
+    key_material = encryption.Pbkdf2Kdf().derive(key, salt)
+    print()
+    print(f'{"cipher":<20}{"KB":>6}{"enc MB/s":>10}{"dec MB/s":>10}{"overhead B":>12}')
+    for name, cipher_class in encryption.CIPHERS.items():
+        cipher = cipher_class(key_material)
+        for size_kb in SIZES_KB:
+            data = os.urandom(size_kb * 512).hex().encode()  # size_kb KB
+            token = cipher.encrypt(data)
+            megabytes = len(data) / 1e6
+            encrypt = best_of(lambda: cipher.encrypt(data))
+            decrypt = best_of(lambda: cipher.decrypt(token))
+            print(
+                f'{name:<20}{size_kb:>6}{megabytes / encrypt:>10.1f}{megabytes / decrypt:>10.1f}'
+                f'{len(token) - len(data):>12}'
+            )
+
+
+if __name__ == '__main__':
+    main()
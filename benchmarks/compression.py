@@ -0,0 +1,49 @@
+'''Stored size and cost of encrypting messages with and without compression
+
+    python -m benchmarks.compression
+'''
+import random
+
+from benchmarks import best_of, setup_django
+
+setup_django()
+
+from app import encryption  # noqa: E402
+from benchmarks.datagen import message_text  # noqa: E402
+
+
+def _log_lines(count: int) -> str:
+    rng = random.Random(0)
+    return '\n'.join(
+        f'2025-01-26T10:{i // 60 % 60:02d}:{i % 60:02d} INFO worker-{rng.randint(1, 8)} '
+        f'processed job {rng.randint(10000, 99999)} in {rng.random() * 100:.1f}ms'
+        for i in range(count)
+    )
+
+
+def main():
+    key, salt = 'SuperSecretKey123', 1234567890
+    encryption.configure_key_cache()  # leave the KDF out, it is the same either way
+    payloads = [
+        ('chat line', message_text(random.Random(1))),
+        ('log paste 10KB', _log_lines(150)),
+        ('log paste 1MB', _log_lines(15000)),
+    ]
+
+    print(f'{"payload":<16}{"compressed":>12}{"plain B":>10}{"stored B":>10}{"enc ms":>9}{"dec ms":>9}')
+    for compress in (False, True):
+        if compress:
+            encryption.configure_compression()
+        for name, data in payloads:
+            token = encryption.encrypt_data(key, salt, data)
+            encrypt = best_of(lambda: encryption.encrypt_data(key, salt, data))
+            decrypt = best_of(lambda: encryption.decrypt_data(key, salt, token))
+            print(
+                f'{name:<16}{str(compress):>12}{len(data.encode()):>10}{len(token):>10}'
+                f'{encrypt * 1000:>9.3f}{decrypt * 1000:>9.3f}'
+            )
+    encryption.disable_compression()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+'''Messages/sec with several processes sending at once, per database profile
+
+    python -m benchmarks.concurrent_writers [--writers 4] [--messages 100] [--readers 1]
+
+Runs each profile from encrypted_db/database.py - SQLite with Django's defaults, tuned SQLite, and
+PostgreSQL when DATABASE_URL is set - against a fresh database. For PostgreSQL that is a throwaway
+test database created next to the one DATABASE_URL names (as `manage.py test` would), and dropped
+afterwards - the configured database itself is never touched. Writers post unencrypted messages
+(so the database, not key derivation, is the bottleneck) while readers keep listing them; failed
+requests are mostly "database is locked".
+'''
+import argparse
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from urllib.parse import quote, urlsplit, urlunsplit
+
+PROFILES = {
+    'sqlite-default': {'DATABASE_URL': '', 'DB_SQLITE_TUNING': '0'},
+    'sqlite-tuned': {'DATABASE_URL': '', 'DB_SQLITE_TUNING': '1'},
+}
+
+
+def _setup(environ: dict):
+    os.environ.update(environ)
+    from benchmarks import setup_django
+    setup_django()
+
+    from django.test.utils import setup_test_environment
+    setup_test_environment()  # lets the test client's requests through ALLOWED_HOSTS
+    logging.getLogger('django.request').setLevel(logging.CRITICAL)  # failures are counted instead
+
+
+def _migrate(environ: dict):
+    _setup(environ)
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+    from app.models import AppUser
+    AppUser.objects.bulk_create([AppUser(name='Alfie'), AppUser(name='Brenda')])
+
+
+def _create_test_database(url: str, names):
+    _setup({'DATABASE_URL': url, 'DB_POOL': '0'})
+    from django.db import connection
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    names.put(connection.settings_dict['NAME'])
+
+
+def _destroy_test_database(url: str):
+    _setup({'DATABASE_URL': url, 'DB_POOL': '0'})
+    from django.db import connection
+    connection.creation.destroy_test_db(verbosity=0)
+
+
+@contextmanager
+def test_database(url: str):
+    '''The URL of a fresh test database on the server `url` points at, dropped afterwards'''
+    context = multiprocessing.get_context('spawn')
+    names = context.Queue()
+    create = context.Process(target=_create_test_database, args=(url, names))
+    create.start()
+    create.join()
+    if create.exitcode:
+        raise RuntimeError('Could not create the test database')
+    test_url = urlunsplit(urlsplit(url)._replace(path='/' + quote(names.get())))
+    try:
+        yield test_url
+    finally:
+        destroy = context.Process(target=_destroy_test_database, args=(test_url,))
+        destroy.start()
+        destroy.join()
+
+
+def _write(environ: dict, count: int, start, results):
+    _setup(environ)
+    from django.db import OperationalError
+    from django.test import Client
+
+    from app.models import AppUser
+
+    client = Client()
+    user_from, user_to = AppUser.objects.all()[:2]
+    message = {'user_from': user_from.id, 'user_to': user_to.id, 'content': 'lorem ipsum ' * 10}
+    start.wait()
+    sent = failed = 0
+    for _ in range(count):
+        try:
+            response = client.post('/api/send-message/', data=message)
+            sent += response.status_code == 201
+            failed += response.status_code != 201
+        except OperationalError:
+            failed += 1
+    results.put((sent, failed))
+
+
+def _read(environ: dict, start, stop):
+    _setup(environ)
+    from django.db import OperationalError
+    from django.test import Client
+
+    client = Client()
+    start.wait()
+    while not stop.is_set():
+        try:
+            client.get('/api/view-messages/?page_size=50')
+        except OperationalError:
+            pass
+
+
+def run(environ: dict, writers: int, messages: int, readers: int) -> tuple[float, int, int]:
+    if not environ['DATABASE_URL']:
+        return _run(environ, writers, messages, readers)
+    with test_database(environ['DATABASE_URL']) as url:
+        return _run({**environ, 'DATABASE_URL': url}, writers, messages, readers)
+
+
+def _run(environ: dict, writers: int, messages: int, readers: int) -> tuple[float, int, int]:
+    context = multiprocessing.get_context('spawn')  # fresh Django (and settings) per process
+    migrate = context.Process(target=_migrate, args=(environ,))
+    migrate.start()
+    migrate.join()
+
+    start, stop, results = context.Barrier(writers + readers + 1), context.Event(), context.Queue()
+    processes = [
+        context.Process(target=_write, args=(environ, messages, start, results))
+        for _ in range(writers)
+    ] + [context.Process(target=_read, args=(environ, start, stop)) for _ in range(readers)]
+    for process in processes:
+        process.start()
+
+    start.wait()
+    began = time.perf_counter()
+    totals = [results.get() for _ in range(writers)]
+    elapsed = time.perf_counter() - began
+    stop.set()
+    for process in processes:
+        process.join()
+
+    sent = sum(sent for sent, _ in totals)
+    return sent / elapsed, sent, sum(failed for _, failed in totals)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--messages', type=int, default=100, help='per writer')
+    parser.add_argument('--readers', type=int, default=1)
+    args = parser.parse_args()
+
+    profiles = dict(PROFILES)
+    if url := os.environ.get('DATABASE_URL'):
+        profiles['postgres'] = {'DATABASE_URL': url}
+        profiles['postgres-pool'] = {'DATABASE_URL': url, 'DB_POOL': '1'}
+
+    print(f'{"profile":<16}{"messages/s":>12}{"sent":>8}{"failed":>8}')
+    with tempfile.TemporaryDirectory() as directory:
+        for name, profile in profiles.items():
+            environ = {'DB_SQLITE_PATH': os.path.join(directory, f'{name}.sqlite3'), **profile}
+            rate, sent, failed = run(environ, args.writers, args.messages, args.readers)
+            print(f'{name:<16}{rate:>12,.1f}{sent:>8}{failed:>8}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+'''Seeds the database with users and messages shaped like real traffic
+
+Message lengths are log-normal (mostly short chat lines, with a long tail of pasted paragraphs), and
+senders/recipients are skewed so a few users send most messages. Everything is drawn from a seeded
+RNG, so the same arguments always produce the same plaintext.
+
+Rows are encrypted the cheap way for their mode, so large tables seed in reasonable time:
+- 'envelope': one envelope per sender, AES work only per row
+- 'salted': rows share a salt per batch of `batch_size` (as the bulk endpoint writes them)
+- 'none': stored unencrypted
+'''
+import random
+from datetime import datetime, timedelta
+
+from django.db import transaction
+
+from app.models import AppUser, KeyEnvelope, Message, MessageEncrypted, Sequence, get_lookup_key
+
+KEY = 'SuperSecretKey123'
+ENCRYPTION_MODES = ('envelope', 'salted', 'none')
+
+_WORDS = (
+    'the quick brown fox jumps over lazy dog meeting tomorrow lunch call me back when you can '
+    'thanks see attached report deadline moved friday sounds good'
+).split()
+
+
+def message_length(rng: random.Random) -> int:
+    # median ~60 characters, 99th percentile ~1,000, capped at 8,000
+    return min(8000, max(1, int(rng.lognormvariate(4.1, 1.2))))
+
+
+def message_text(rng: random.Random) -> str:
+    length = message_length(rng)
+    words = []
+    while sum(len(word) + 1 for word in words) < length:
+        words.append(rng.choice(_WORDS))
+    return ' '.join(words)[:length]
+
+
+def create_users(count: int) -> list[AppUser]:
+    users = [AppUser(name=f'user{i}') for i in range(count)]
+    return AppUser.objects.bulk_create(users)
+
+
+def seed_messages(
+    count: int, users: list[AppUser], encryption: str = 'envelope', key: str = KEY,
+    batch_size: int = 1000, seed: int = 0,
+) -> int:
+    '''Add `count` messages between `users`, returning how many were written'''
+    if encryption not in ENCRYPTION_MODES:
+        raise ValueError(f'encryption must be one of {ENCRYPTION_MODES}')
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(len(users))]  # Zipf-like: a few chatty users
+    lookup_key = get_lookup_key(key) if encryption == 'envelope' else None
+    envelopes = {}
+    started = datetime(2025, 1, 1)
+
+    written = 0
+    while written < count:
+        batch = []
+        for i in range(written, min(count, written + batch_size)):
+            user_from, user_to = rng.choices(users, weights, k=2)
+            batch.append(MessageEncrypted(
+                created_at=(started + timedelta(seconds=i * 37)).isoformat(),
+                user_from=str(user_from.id), user_to=str(user_to.id), content=message_text(rng),
+            ))
+
+        if encryption == 'salted':
+            MessageEncrypted.encrypt_many(batch, key)
+        elif encryption == 'envelope':
+            for message_enc in batch:
+                owner_id = message_enc.user_from
+                if owner_id not in envelopes:
+                    envelopes[owner_id] = KeyEnvelope.create_for(owner_id, key)
+                message_enc.encrypt_with_envelope(*envelopes[owner_id], lookup_key)
+        else:
+            for message_enc in batch:
+                message_enc.salt = rng.randint(0, 1000)
+
+        with transaction.atomic():
+            first_sequence = Sequence.allocate('message', len(batch))
+            MessageEncrypted.objects.bulk_create(batch)
+            Message.objects.bulk_create([
+                Message(encrypted=message_enc, sequence=first_sequence + i)
+                for i, message_enc in enumerate(batch)
+            ])
+        written += len(batch)
+    return written
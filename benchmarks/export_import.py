@@ -0,0 +1,75 @@
+'''Rows/sec and peak memory of export_messages and import_messages
+
+    python -m benchmarks.export_import [--messages 100000] [--memory]
+
+Seeds a throwaway database with envelope-encrypted messages, exports it, empties it and imports
+the file back. With --memory, peak Python memory is traced too (which slows both steps down) - it
+should stay flat as --messages grows.
+'''
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks import setup_django, setup_test_database
+
+setup_django()
+
+
+def measure(func, memory: bool) -> tuple[float, float | None]:
+    '''(seconds, peak MB allocated, if traced) of one call'''
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+    if not memory:
+        return seconds, None
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--memory', action='store_true', help='Also trace peak memory')
+    args = parser.parse_args()
+
+    setup_test_database()
+    from django.conf import settings
+    settings.DEBUG = False  # otherwise every INSERT is kept in connection.queries
+    from app.backup import export_to_file, import_from_file
+    from app.models import AppUser, Conversation, KeyEnvelope, MessageEncrypted
+    from benchmarks.datagen import create_users, seed_messages
+
+    seed_messages(args.messages, create_users(50), encryption='envelope')
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'export.ndjson.gz')
+        totals = {}
+
+        def export():
+            totals.update(export_to_file(path, args.batch_size))
+
+        def clear():
+            for model in (MessageEncrypted, Conversation, KeyEnvelope, AppUser):
+                model.objects.all().delete()
+
+        print(f'{"step":<10}{"seconds":>10}{"rows/s":>12}{"peak MB":>10}')
+        for name, setup, func in [
+            ('export', None, export), ('import', clear, lambda: import_from_file(path)),
+        ]:
+            if setup is not None:
+                setup()
+            seconds, peak = measure(func, args.memory)
+            rows = sum(totals.values())
+            peak = '-' if peak is None else f'{peak:.1f}'
+            print(f'{name:<10}{seconds:>10.2f}{rows / seconds:>12,.0f}{peak:>10}')
+        print(f'{rows} rows, {os.path.getsize(path) / 1e6:.1f} MB file')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+'''Throughput and p50/p95/p99 latency per endpoint, under concurrent mixed traffic
+
+    python -m benchmarks.load [--concurrency 8] [--duration 20] [--read-ratio 0.5]
+                              [--keys 3] [--key-skew zipf] [--users 50] [--seed-messages 1000]
+                              [--url http://127.0.0.1:8000] [--output load.json]
+
+Without --url the app runs in-process, on a throwaway (tuned) SQLite database, with one thread per
+concurrent client - the capacity of a single threaded worker. With --url it drives a server that is
+already running (runserver, uvicorn encrypted_db.asgi:application, ...) over HTTP, against whatever
+database that server uses. Either way nothing leaves the machine.
+
+Each client loops until --duration runs out, sending a message (from a skewed set of users, under
+one of --keys passphrases) or reading a page of messages under one of them. --key-skew zipf makes a
+few passphrases account for most traffic; 0 keys sends everything unencrypted.
+'''
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import random
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime, timezone
+
+ENDPOINTS = ('send-message', 'view-messages')
+
+
+class InProcessTransport:
+    '''Requests through Django's test client - one client (and DB connection) per thread'''
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def request(self, method: str, path: str, data: dict = None) -> tuple[int, bytes]:
+        from django.test import Client
+
+        if not hasattr(self._local, 'client'):
+            self._local.client = Client()
+        if method == 'GET':
+            response = self._local.client.get(path)
+        else:
+            response = self._local.client.post(path, data=data, content_type='application/json')
+        return response.status_code, response.content
+
+
+class HttpTransport:
+    def __init__(self, url: str):
+        self.url = url.rstrip('/')
+
+    def request(self, method: str, path: str, data: dict = None) -> tuple[int, bytes]:
+        body = json.dumps(data).encode() if data is not None else None
+        request = urllib.request.Request(
+            self.url + path, data=body, method=method, headers={'Content-Type': 'application/json'},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as error:
+            return error.code, error.read()
+
+
+def _setup_in_process(directory: str) -> InProcessTransport:
+    os.environ.update({'DATABASE_URL': '', 'DB_SQLITE_PATH': os.path.join(directory, 'load.sqlite3')})
+    from benchmarks import setup_django
+    setup_django()
+
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.test.utils import setup_test_environment
+
+    call_command('migrate', verbosity=0)
+    setup_test_environment()  # lets the test client's requests through ALLOWED_HOSTS
+    settings.DEBUG = False  # otherwise every query is kept in connection.queries
+    logging.getLogger('django.request').setLevel(logging.CRITICAL)  # errors are counted instead
+    return InProcessTransport()
+
+
+def _weights(count: int, skew: str) -> list[float]:
+    return [1 / (rank + 1) if skew == 'zipf' else 1.0 for rank in range(count)]
+
+
+def percentile(sorted_values: list[float], percent: float) -> float:
+    '''Nearest-rank percentile of an already sorted list'''
+    return sorted_values[max(0, math.ceil(percent / 100 * len(sorted_values)) - 1)]
+
+
+class LoadTest:
+    def __init__(self, transport, args):
+        from benchmarks.datagen import message_text
+
+        self.transport = transport
+        self.args = args
+        self.message_text = message_text
+        self.keys = [f'load-key-{i}' for i in range(args.keys)]
+        self.key_weights = _weights(args.keys, args.key_skew)
+        self.users: list[str] = []
+        self.user_weights: list[float] = []
+        self.latencies = {endpoint: [] for endpoint in ENDPOINTS}
+        self.errors = {endpoint: 0 for endpoint in ENDPOINTS}
+        self._lock = threading.Lock()
+
+    def _key(self, rng: random.Random) -> str | None:
+        return rng.choices(self.keys, self.key_weights)[0] if self.keys else None
+
+    def seed(self):
+        for i in range(self.args.users):
+            status, body = self.transport.request('POST', '/api/app-users/', {'name': f'load{i}'})
+            if status != 201:
+                raise RuntimeError(f'Could not create users: {status} {body[:200]!r}')
+            self.users.append(json.loads(body)['id'])
+        self.user_weights = _weights(len(self.users), 'zipf')  # a few chatty users, as in datagen
+
+        rng = random.Random(0)
+        for start in range(0, self.args.seed_messages, 1000):
+            count = min(1000, self.args.seed_messages - start)
+            messages = [self._message(rng) for _ in range(count)]
+            payload = {'messages': messages}
+            if key := self._key(rng):
+                payload['key'] = key
+            self.transport.request('POST', '/api/send-messages/bulk/', payload)
+
+    def _message(self, rng: random.Random) -> dict:
+        user_from, user_to = rng.choices(self.users, self.user_weights, k=2)
+        return {'user_from': user_from, 'user_to': user_to, 'content': self.message_text(rng)}
+
+    def _call(self, rng: random.Random) -> tuple[str, str, str, dict | None]:
+        key = self._key(rng)
+        if rng.random() < self.args.read_ratio:
+            query = f'?page_size={self.args.page_size}' + (f'&key={key}' if key else '')
+            return 'view-messages', 'GET', f'/api/view-messages/{query}', None
+        payload = self._message(rng)
+        if key:
+            payload['key'] = key
+        return 'send-message', 'POST', '/api/send-message/', payload
+
+    def _client(self, number: int, start: threading.Barrier, deadline: list[float]):
+        rng = random.Random(number)
+        latencies = {endpoint: [] for endpoint in ENDPOINTS}
+        errors = dict.fromkeys(ENDPOINTS, 0)
+        start.wait()
+        while time.perf_counter() < deadline[0]:
+            endpoint, method, path, payload = self._call(rng)
+            began = time.perf_counter()
+            try:
+                status, _ = self.transport.request(method, path, payload)
+            except Exception:
+                status = None
+            elapsed = time.perf_counter() - began
+            if status is not None and status < 400:
+                latencies[endpoint].append(elapsed)
+            else:
+                errors[endpoint] += 1
+
+        with self._lock:
+            for endpoint in ENDPOINTS:
+                self.latencies[endpoint] += latencies[endpoint]
+                self.errors[endpoint] += errors[endpoint]
+
+    def run(self) -> float:
+        '''Drive traffic for --duration seconds, returning the measured wall-clock time'''
+        start, deadline = threading.Barrier(self.args.concurrency + 1), [math.inf]
+        clients = [
+            threading.Thread(target=self._client, args=(number, start, deadline))
+            for number in range(self.args.concurrency)
+        ]
+        for client in clients:
+            client.start()
+        start.wait()
+        began = time.perf_counter()
+        deadline[0] = began + self.args.duration
+        for client in clients:
+            client.join()
+        return time.perf_counter() - began
+
+    def results(self, elapsed: float) -> list[dict]:
+        results = []
+        everything = sorted(value for values in self.latencies.values() for value in values)
+        for endpoint, values in [*self.latencies.items(), ('all', everything)]:
+            values = sorted(values)
+            errors = sum(self.errors.values()) if endpoint == 'all' else self.errors[endpoint]
+            result = {'endpoint': endpoint, 'requests': len(values), 'errors': errors,
+                      'per_second': len(values) / elapsed}
+            if values:
+                result.update({
+                    f'p{p}_ms': percentile(values, p) * 1000 for p in (50, 95, 99)
+                })
+            results.append(result)
+        return results
+
+
+def _print(results: list[dict]):
+    print(f'{"endpoint":<16}{"requests":>10}{"errors":>8}{"req/s":>10}'
+          f'{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+    for result in results:
+        timings = ''.join(
+            f'{result[f"p{p}_ms"]:>10.1f}' if f'p{p}_ms' in result else f'{"-":>10}'
+            for p in (50, 95, 99)
+        )
+        print(f'{result["endpoint"]:<16}{result["requests"]:>10}{result["errors"]:>8}'
+              f'{result["per_second"]:>10.1f}{timings}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', help='Drive a running server instead of the app in-process')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20, help='Seconds of traffic')
+    parser.add_argument('--read-ratio', type=float, default=0.5, help='Share of requests that list')
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--keys', type=int, default=3, help='Passphrases in use - 0 for plaintext')
+    parser.add_argument('--key-skew', choices=('uniform', 'zipf'), default='zipf')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--seed-messages', type=int, default=1000)
+    parser.add_argument('--output', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+    if args.concurrency < 1 or args.users < 2 or not 0 <= args.read_ratio <= 1:
+        parser.error('needs --concurrency >= 1, --users >= 2 and --read-ratio between 0 and 1')
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.url:
+            from benchmarks import setup_django
+            setup_django()  # only for benchmarks.datagen's message text - no database is opened
+            transport = HttpTransport(args.url)
+        else:
+            transport = _setup_in_process(directory)
+        load = LoadTest(transport, args)
+        load.seed()
+        results = load.results(load.run())
+
+    _print(results)
+    if args.output:
+        from benchmarks.suite import _commit
+
+        with open(args.output, 'w') as output:
+            json.dump({
+                'meta': {
+                    'commit': _commit(),
+                    'timestamp': datetime.now(timezone.utc).isoformat(),
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'cpu_count': os.cpu_count(),
+                    'target': args.url or 'in-process',
+                    'args': vars(args),
+                },
+                'results': results,
+            }, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+'''Throughput of DecryptionExecutor in serial, thread and process-pool modes
+
+    python -m benchmarks.parallel_decrypt [--sizes 1000 10000 100000] [--per-salt]
+
+By default rows are envelope-encrypted (one data key, AES work only). With --per-salt every row has
+its own salt and so costs a full key derivation - use smaller sizes for that.
+'''
+import argparse
+import os
+import time
+
+from benchmarks import setup_django
+
+setup_django()
+
+from app.encryption import encrypt_record_with_data_key, generate_data_key  # noqa: E402
+from app.executors import DecryptionExecutor  # noqa: E402
+from app.models import KeyEnvelope, Keyring, MessageEncrypted  # noqa: E402
+
+KEY = 'SuperSecretKey123'
+
+
+def _values(i: int) -> dict[str, str]:
+    return {
+        'created_at': f'2025-01-26T10:13:{i % 60:02d}.098331',
+        'user_from': 'a2f08389-3959-4436-8b20-2666133f7e32',
+        'user_to': '53d5ebc5-9dd5-489b-b7bd-74b37f5bfd06',
+        'content': f'Message number {i} - ' + 'lorem ipsum ' * 10,
+    }
+
+
+def make_rows(count: int, per_salt: bool) -> tuple[list[dict], Keyring]:
+    '''Encrypted field values plus the salt/envelope needed to rebuild each row'''
+    keyring = Keyring(KEY)
+    if per_salt:
+        rows = []
+        for i in range(count):
+            message = MessageEncrypted(**_values(i)).encrypt(KEY)
+            rows.append({'salt': message.salt, **message._encrypted_values()})
+        return rows, keyring
+
+    envelope = KeyEnvelope(id=1)  # never saved; the data key is primed on the keyring instead
+    data_key = generate_data_key()
+    keyring._data_keys[envelope.id] = data_key
+    rows = [
+        {'salt': '', 'envelope': envelope, **encrypt_record_with_data_key(data_key, _values(i))}
+        for i in range(count)
+    ]
+    return rows, keyring
+
+
+def run(executor: DecryptionExecutor, rows: list[dict], keyring: Keyring) -> float:
+    instances = [MessageEncrypted(**row) for row in rows]
+    start = time.perf_counter()
+    executor.decrypt_all(instances, keyring)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--per-salt', action='store_true')
+    args = parser.parse_args()
+
+    executors = [DecryptionExecutor(mode, max_workers=args.workers) for mode in DecryptionExecutor.MODES]
+    print(f'{"rows":>8}' + ''.join(f'{executor.mode + " rows/s":>20}' for executor in executors))
+    for size in args.sizes:
+        rows, keyring = make_rows(size, args.per_salt)
+        for executor in executors:
+            run(executor, rows[:executor.max_workers * 2], keyring)  # warm the pool up
+        rates = [size / run(executor, rows, keyring) for executor in executors]
+        print(f'{size:>8}' + ''.join(f'{rate:>20,.0f}' for rate in rates))
+
+    for executor in executors:
+        executor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+'''Per-row cost of EncryptedMixin.encrypt/decrypt: one key derivation per field vs per record
+
+    python -m benchmarks.record_crypto
+'''
+from unittest import mock
+
+from benchmarks import best_of, setup_django
+
+setup_django()
+
+from app import encryption  # noqa: E402
+from app.models import MessageEncrypted  # noqa: E402
+
+
+def _row() -> MessageEncrypted:
+    return MessageEncrypted(
+        created_at='2025-01-26T10:13:11.098331',
+        user_from='a2f08389-3959-4436-8b20-2666133f7e32',
+        user_to='53d5ebc5-9dd5-489b-b7bd-74b37f5bfd06',
+        content='I have something really important to tell you but it must remain private',
+    )
+
+
+def per_field_encrypt(key: str, row: MessageEncrypted):
+    # the previous implementation: one encrypt_data (and so one KDF) per field
+    for field in row._encrypted_field_names():
+        setattr(row, field, encryption.encrypt_data(key, int(row.salt), str(getattr(row, field))))
+
+
+def per_field_decrypt(key: str, row: MessageEncrypted):
+    for field in row._encrypted_field_names():
+        setattr(row, field, encryption.decrypt_data(key, int(row.salt), str(getattr(row, field))))
+
+
+def count_kdf_calls(func) -> int:
+    with mock.patch.object(encryption, '_derive_key', wraps=encryption._derive_key) as derive:
+        func()
+    return derive.call_count
+
+
+def main():
+    key = 'SuperSecretKey123'
+
+    def old_write():
+        row = _row()
+        row.salt = 1234567890
+        per_field_encrypt(key, row)
+
+    def new_write():
+        _row().encrypt(key)
+
+    encrypted = _row().encrypt(key)
+    values = {field: getattr(encrypted, field) for field in encrypted._encrypted_field_names()}
+
+    def old_read():
+        row = MessageEncrypted(salt=encrypted.salt, **values)
+        per_field_decrypt(key, row)
+
+    def new_read():
+        MessageEncrypted(salt=encrypted.salt, **values).decrypt(key)
+
+    print(f'{"path":<24}{"KDF calls":>10}{"ms/row":>10}')
+    for name, func in [
+        ('per-field encrypt', old_write), ('per-record encrypt', new_write),
+        ('per-field decrypt', old_read), ('per-record decrypt', new_read),
+    ]:
+        print(f'{name:<24}{count_kdf_calls(func):>10}{best_of(func) * 1000:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
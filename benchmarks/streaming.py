@@ -0,0 +1,55 @@
+'''Peak memory and time of encrypting one large body as a str vs as a stream
+
+    python -m benchmarks.streaming [--megabytes 50]
+'''
+import argparse
+import io
+import time
+import tracemalloc
+
+from benchmarks import setup_django
+
+setup_django()
+
+from app import encryption  # noqa: E402
+
+
+def measure(func) -> tuple[float, float]:
+    '''(seconds, peak MB allocated) of one call'''
+    tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--megabytes', type=int, default=50)
+    args = parser.parse_args()
+
+    key_material = encryption.generate_data_key()
+    size = args.megabytes * 1_000_000
+    line = b'2025-01-26T10:13:11 INFO worker processed job in 12.3ms\n'
+    body = line * (size // len(line))
+    text = body.decode()
+
+    def whole():
+        token = encryption._Ciphers(key_material).encrypt(encryption.DEFAULT_SCHEME, text)
+        encryption._Ciphers(key_material).decrypt(token)
+
+    def streamed():
+        frames = encryption.encrypt_stream(key_material, encryption.iter_file(io.BytesIO(body)))
+        for _ in encryption.decrypt_stream(key_material, frames):
+            pass
+
+    print(f'{"path":<12}{"seconds":>10}{"peak MB":>10}   ({len(body) / 1e6:.0f} MB body)')
+    for name, func in [('str', whole), ('stream', streamed)]:
+        seconds, peak = measure(func)
+        print(f'{name:<12}{seconds:>10.2f}{peak:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
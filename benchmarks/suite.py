@@ -0,0 +1,186 @@
+'''The full benchmark suite, written to JSON so runs can be compared between commits
+
+    python -m benchmarks.suite [--sizes 100 1000 10000 100000] [--output bench.json]
+    python -m benchmarks.suite --compare before.json after.json
+
+Covers encrypt_data/decrypt_data by payload size (with and without the derived key cache),
+EncryptedMixin.encrypt/decrypt per row, and the send/list endpoints as the table grows. Runs offline
+against a throwaway SQLite database, seeded by benchmarks.datagen. Each result is the best of
+several runs (a single run for the largest tables).
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+from benchmarks import best_of, setup_django, setup_test_database
+
+KEY = 'SuperSecretKey123'
+PAYLOAD_SIZES = (64, 1024, 16 * 1024, 256 * 1024)
+TABLE_SIZES = (100, 1000, 10000, 100000)
+SENDS_PER_SIZE = 20
+
+
+def _result(name: str, seconds: float, phases: dict = None, **params) -> dict:
+    result = {'name': name, 'params': params, 'seconds': seconds}
+    if phases is not None:
+        result['phases'] = phases  # where the time went, from app.metrics
+    return result
+
+
+def bench_primitives() -> list[dict]:
+    from app import encryption
+
+    results = []
+    for cached in (False, True):
+        if cached:
+            encryption.configure_key_cache()
+        for size in PAYLOAD_SIZES:
+            data = 'x' * size
+            token = encryption.encrypt_data(KEY, 123, data)
+            results += [
+                _result('encrypt_data', best_of(lambda: encryption.encrypt_data(KEY, 123, data)),
+                        bytes=size, key_cache=cached),
+                _result('decrypt_data', best_of(lambda: encryption.decrypt_data(KEY, 123, token)),
+                        bytes=size, key_cache=cached),
+            ]
+    encryption.disable_key_cache()
+    return results
+
+
+def bench_records() -> list[dict]:
+    import random
+
+    from app.models import MessageEncrypted
+    from benchmarks.datagen import message_text
+
+    text = message_text(random.Random(0))
+
+    def new_row():
+        return MessageEncrypted(
+            created_at='2025-01-26T10:13:11.098331', user_from='a2f08389-3959-4436-8b20-2666133f7e32',
+            user_to='53d5ebc5-9dd5-489b-b7bd-74b37f5bfd06', content=text,
+        )
+
+    encrypted = new_row().encrypt(KEY)
+    values = encrypted._encrypted_values()
+    return [
+        _result('record.encrypt', best_of(lambda: new_row().encrypt(KEY))),
+        _result('record.decrypt', best_of(
+            lambda: MessageEncrypted(salt=encrypted.salt, **values).decrypt(KEY)
+        )),
+    ]
+
+
+def bench_endpoints(sizes: list[int]) -> list[dict]:
+    from django.test import Client, override_settings
+
+    from app import metrics
+    from app.models import AppUser
+    from benchmarks.datagen import create_users, seed_messages
+
+    client = Client()
+    users = create_users(50)
+    results, seeded = [], 0
+    for size in sorted(sizes):
+        seeded += seed_messages(size - seeded, users, encryption='envelope', seed=size)
+        repeat = 5 if size <= 1000 else 1
+
+        user_from, user_to = AppUser.objects.all()[:2]
+        message = {'user_from': user_from.id, 'user_to': user_to.id, 'content': 'hello', 'key': KEY}
+        with override_settings(ENCRYPTION_ENVELOPE_MODE=True):
+            def send():
+                for _ in range(SENDS_PER_SIZE):
+                    client.post('/api/send-message/', data=message)
+            results.append(_result(
+                'send-message', best_of(send, repeat=1) / SENDS_PER_SIZE, messages=size,
+            ))
+        seeded += SENDS_PER_SIZE
+
+        for name, url in [
+            ('view-messages', '/api/view-messages/'),
+            ('view-messages?key', f'/api/view-messages/?key={KEY}'),
+            ('view-messages?key&page_size=50', f'/api/view-messages/?key={KEY}&page_size=50'),
+        ]:
+            seconds = best_of(lambda: client.get(url), repeat=repeat)
+            # one more, instrumented, run for the breakdown - kept out of the timing above
+            sink = metrics.configure_metrics('memory')
+            client.get(url)
+            metrics.disable_metrics()
+            phases = {
+                phase: round(total, 6) for phase, (total, _) in sink.snapshot()['timers'].items()
+                if phase.startswith('view.') or phase == 'crypto.kdf'
+            }
+            results.append(_result(name, seconds, phases, messages=size))
+    return results
+
+
+def _commit() -> str | None:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _key(result: dict) -> str:
+    return result['name'] + json.dumps(result['params'], sort_keys=True)
+
+
+def compare(before_path: str, after_path: str):
+    '''Print every result in both files, with how much slower (+) or faster (-) it got'''
+    with open(before_path) as before_file, open(after_path) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+    previous = {_key(result): result['seconds'] for result in before['results']}
+
+    print(f'{before["meta"]["commit"]} -> {after["meta"]["commit"]}')
+    print(f'{"benchmark":<64}{"before ms":>12}{"after ms":>12}{"change":>9}')
+    for result in after['results']:
+        if (old := previous.get(_key(result))) is None:
+            continue
+        label = ' '.join([result['name'], *(f'{k}={v}' for k, v in result['params'].items())])
+        change = (result['seconds'] - old) / old * 100
+        print(f'{label:<64}{old * 1000:>12.3f}{result["seconds"] * 1000:>12.3f}{change:>+8.1f}%')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(TABLE_SIZES))
+    parser.add_argument('--output', default='bench.json')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'))
+    args = parser.parse_args()
+
+    if args.compare:
+        return compare(*args.compare)
+
+    setup_django()
+    setup_test_database()
+
+    results = []
+    for name, bench in [
+        ('primitives', bench_primitives), ('records', bench_records),
+        ('endpoints', lambda: bench_endpoints(args.sizes)),
+    ]:
+        print(f'running {name}...', file=sys.stderr)
+        results += bench()
+
+    with open(args.output, 'w') as output:
+        json.dump({
+            'meta': {
+                'commit': _commit(),
+                'timestamp': datetime.now(timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+            },
+            'results': results,
+        }, output, indent=2)
+    print(f'wrote {len(results)} results to {args.output}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
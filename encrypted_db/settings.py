@@ -10,8 +10,11 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
+from .database import database_from_env
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -42,6 +45,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'app.middleware.ServerTimingMiddleware',  # removes itself unless ENCRYPTION_METRICS enables it
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -75,11 +79,10 @@ WSGI_APPLICATION = 'encrypted_db.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# SQLite (tuned for concurrent writers) unless DATABASE_URL points at PostgreSQL - see
+# encrypted_db/database.py for the environment variables
 DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+    'default': database_from_env(os.environ, BASE_DIR),
 }
 
 
@@ -123,3 +126,59 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Encryption
+
+# Opt-in in-process cache of derived keys, e.g. {'max_size': 128, 'ttl': 300}. Holds key material in
+# memory for up to `ttl` seconds - leave as None to derive on every request.
+ENCRYPTION_KEY_CACHE = None
+
+# Encrypt new messages under a per-user data key (see app.models.KeyEnvelope) rather than a key
+# derived per message. Listing then costs one key derivation per envelope instead of per message.
+ENCRYPTION_ENVELOPE_MODE = False
+
+# How list endpoints decrypt their rows: {'mode': 'serial' | 'thread' | 'process', 'max_workers': n}.
+# Pools pay off for large result sets; see benchmarks/parallel_decrypt.py.
+ENCRYPTION_DECRYPT_EXECUTOR = {'mode': 'serial'}
+
+# Mixed into the key for key tags, blind indexes and conversation pair keys (see
+# EncryptedMixin.blind_index_fields). Its own secret, so SECRET_KEY can be rotated without touching
+# it: changing the pepper makes every existing row unmatchable - keyed listings skip them - until
+# `rekey_messages --old-pepper` has re-tagged them. Required unless DEBUG.
+ENCRYPTION_LOOKUP_PEPPER = os.environ.get('ENCRYPTION_LOOKUP_PEPPER', SECRET_KEY if DEBUG else '')
+
+# In-process cache of blind index lookup keys, which every encrypted write needs. Each passphrase
+# has just one, so a small cache saves a key derivation on nearly every send. None derives it every
+# time; a lookup key cannot decrypt records, but can test guesses against the indexes.
+ENCRYPTION_LOOKUP_KEY_CACHE = {'max_size': 64, 'ttl': 300}
+
+# Where the async endpoints run key derivation and encryption: {'mode': 'process' | 'thread',
+# 'max_workers': n}. PBKDF2 holds the GIL, so only a process pool keeps the event loop free.
+ENCRYPTION_ASYNC_EXECUTOR = {'mode': 'process', 'max_workers': 2}
+
+# KDF + cipher for new writes - a version from app.encryption.SCHEMES. Existing rows record their
+# own scheme, so this can be changed at any time. 1 is PBKDF2 + Fernet; 2 (PBKDF2 + AES-256-GCM)
+# and 3 (PBKDF2 + ChaCha20-Poly1305) are faster AEAD options. See benchmarks/ciphers.py.
+ENCRYPTION_SCHEME = 1
+
+# Timers and counters around key derivation, encryption and the list views (see app.metrics), e.g.
+# {'sink': 'memory' | 'log' | 'prometheus', 'server_timing': True}. 'prometheus' is scraped from
+# /api/metrics/; server_timing adds a per-request Server-Timing header. None measures nothing.
+ENCRYPTION_METRICS = None
+
+# Compress values of at least `threshold` bytes before encrypting them, e.g. {'threshold': 1024,
+# 'level': 6}. Shrinks pasted logs and documents several times over; short values are left alone.
+# Compressed lengths depend on content, so avoid it where attacker-chosen text is stored next to
+# secrets in one field. Values are readable either way, so this can be switched at any time.
+ENCRYPTION_COMPRESSION = None
+
+# Link conversations (see app.models.Conversation) to their participants in plaintext, so they can be
+# listed per user and span passphrases. Off, conversations are only findable with the sender's key -
+# the database does not record who talks to whom.
+ENCRYPTION_CONVERSATION_PARTICIPANTS = False
+
+# Cache of which AppUser ids exist, so sends check their sender and recipient without a query each
+# (see app.users). Saves and deletes in this process drop their entry at once; deletes elsewhere are
+# noticed within `ttl` seconds. None checks against the database every time.
+APP_USER_CACHE = {'max_size': 10000, 'ttl': 60}
@@ -17,11 +17,24 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 
-from app.views import AppUserListView, CreateMessageView, ListMessageView
+from app.views import (
+    AppUserListView, AsyncCreateMessageView, AsyncListMessageView, AsyncMessageSyncView,
+    ConversationListView, ConversationMessagesView, CreateMessageView, CreateMessagesBulkView,
+    ListMessageView, MessageBodyView, MessageSyncView, MetricsView,
+)
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/app-users/', AppUserListView.as_view()),
     path('api/send-message/', CreateMessageView.as_view()),
+    path('api/send-messages/bulk/', CreateMessagesBulkView.as_view()),
     path('api/view-messages/', ListMessageView.as_view()),
+    path('api/messages/sync/', MessageSyncView.as_view()),
+    path('api/messages/<uuid:pk>/body/', MessageBodyView.as_view()),
+    path('api/conversations/', ConversationListView.as_view()),
+    path('api/conversations/<uuid:pk>/messages/', ConversationMessagesView.as_view()),
+    path('api/async/send-message/', AsyncCreateMessageView.as_view()),
+    path('api/async/view-messages/', AsyncListMessageView.as_view()),
+    path('api/async/messages/sync/', AsyncMessageSyncView.as_view()),
+    path('api/metrics/', MetricsView.as_view()),
 ]